@@ -1,21 +1,37 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_from_directory, url_for, Response
 from flask_cors import CORS
 import os
 from werkzeug.utils import secure_filename
-import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from scipy.cluster.hierarchy import linkage, fcluster
-from scipy.spatial.distance import squareform
-from docx import Document
-import PyPDF2
 import csv
+import difflib
 import shutil
-from openai import OpenAI
 import json
-from collections import defaultdict
+import importlib
+import random
+import io
+import zipfile
+import re
+import itertools
+import uuid
+import math
+import multiprocessing
+import queue
+import signal
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
 
+# numpy, scikit-learn, scipy, PyPDF2, python-docx and openai are slow to import,
+# so they are imported by the stage that needs them rather than at startup.
+# Set PRELOAD_DEPENDENCIES=1 (e.g. with gunicorn --preload) to import them once
+# in the master process and share them with forked workers.
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -25,87 +41,2164 @@ CORS(app)  # Enable CORS for all routes
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['ORGANIZED_FOLDER'] = 'organized'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['EXTRACT_MAX_CHARS'] = int(os.getenv('EXTRACT_MAX_CHARS', 10000))  # text budget per document
+app.config['EXTRACT_SAMPLING'] = os.getenv('EXTRACT_SAMPLING', 'head')  # 'head' or 'spread'
+app.config['EXTRACT_WORKERS'] = int(os.getenv('EXTRACT_WORKERS', os.cpu_count() or 1))  # 1 extracts in-process
+app.config['EXTRACT_TIMEOUT'] = int(os.getenv('EXTRACT_TIMEOUT', 30))  # seconds per file
+app.config['EXTRACT_START_METHOD'] = os.getenv(
+    'EXTRACT_START_METHOD', 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+)  # how extraction workers are started; 'fork' is unsafe in a threaded server
+app.config['LLM_MAX_CONCURRENCY'] = int(os.getenv('LLM_MAX_CONCURRENCY', 8))  # max OpenAI calls in flight
+app.config['LLM_REQUESTS_PER_MINUTE'] = int(os.getenv('LLM_REQUESTS_PER_MINUTE', 0))  # 0 disables pacing
+app.config['LLM_TOKENS_PER_MINUTE'] = int(os.getenv('LLM_TOKENS_PER_MINUTE', 0))  # 0 disables pacing
+app.config['LLM_TIMEOUT'] = float(os.getenv('LLM_TIMEOUT', 20))  # seconds per OpenAI request
+app.config['LLM_DEADLINE'] = float(os.getenv('LLM_DEADLINE', 45))  # seconds per analysis, retries included
+app.config['LLM_MAX_RETRIES'] = int(os.getenv('LLM_MAX_RETRIES', 3))  # on rate limits, timeouts and server errors
+app.config['LLM_BACKOFF_BASE'] = float(os.getenv('LLM_BACKOFF_BASE', 0.5))  # seconds, doubled per retry with full jitter
+app.config['LLM_BACKOFF_MAX'] = float(os.getenv('LLM_BACKOFF_MAX', 8))
+app.config['LLM_HEDGE_PERCENTILE'] = float(os.getenv('LLM_HEDGE_PERCENTILE', 0))  # duplicate slow requests past this latency percentile, 0 disables
+app.config['LLM_BREAKER_FAILURES'] = int(os.getenv('LLM_BREAKER_FAILURES', 5))  # consecutive failures that open the breaker
+app.config['LLM_BREAKER_COOLDOWN'] = float(os.getenv('LLM_BREAKER_COOLDOWN', 30))  # seconds before a trial request
+app.config['LLM_BATCH_SIZE'] = int(os.getenv('LLM_BATCH_SIZE', 1))  # documents per request, 1 disables batching
+app.config['LLM_BATCH_TOKEN_BUDGET'] = int(os.getenv('LLM_BATCH_TOKEN_BUDGET', 12000))  # prompt tokens per batch
+app.config['LLM_BATCH_EXCERPT_CHARS'] = int(os.getenv('LLM_BATCH_EXCERPT_CHARS', 2000))  # text per batched document
+app.config['PROMPT_TOKEN_BUDGET'] = int(os.getenv('PROMPT_TOKEN_BUDGET', 600))  # excerpt tokens per document, 0 sends the first 10000 chars
+app.config['ORGANIZER_MODE'] = os.getenv('ORGANIZER_MODE', 'llm')  # 'llm', 'cluster' or 'offline'
+app.config['CLUSTER_DISTANCE_THRESHOLD'] = float(os.getenv('CLUSTER_DISTANCE_THRESHOLD', 0.85))  # cosine distance
+app.config['ANALYSIS_CACHE_PATH'] = os.getenv('ANALYSIS_CACHE_PATH', 'analysis_cache.sqlite3')  # empty disables caching
+app.config['ANALYSIS_CACHE_MAX_ENTRIES'] = int(os.getenv('ANALYSIS_CACHE_MAX_ENTRIES', 50000))
+app.config['ANALYSIS_CACHE_MAX_AGE_DAYS'] = int(os.getenv('ANALYSIS_CACHE_MAX_AGE_DAYS', 90))
+app.config['CATEGORY_INDEX_PATH'] = os.getenv('CATEGORY_INDEX_PATH', 'categories.sqlite3')  # empty disables centroid matching
+app.config['CATEGORY_MATCH_THRESHOLD'] = float(os.getenv('CATEGORY_MATCH_THRESHOLD', 0.4))  # cosine similarity to place locally
+app.config['CATEGORY_MATCH_MARGIN'] = float(os.getenv('CATEGORY_MATCH_MARGIN', 0.05))  # lead needed over the runner-up
+app.config['CATEGORY_MIN_DOCUMENTS'] = int(os.getenv('CATEGORY_MIN_DOCUMENTS', 3))  # documents before a category is matched
+app.config['CATEGORY_MERGE_THRESHOLD'] = float(os.getenv('CATEGORY_MERGE_THRESHOLD', 0.25))  # folds new names into a near category
+app.config['CATEGORY_CENTROID_TERMS'] = 2000
+app.config['NEAR_DUPLICATE_INDEX_PATH'] = os.getenv('NEAR_DUPLICATE_INDEX_PATH', 'near_duplicates.sqlite3')  # empty disables
+app.config['NEAR_DUPLICATE_THRESHOLD'] = float(os.getenv('NEAR_DUPLICATE_THRESHOLD', 0.8))  # estimated Jaccard similarity
+
+app.config['UPLOAD_ASYNC'] = os.getenv('UPLOAD_ASYNC', '1') != '0'  # queue uploads as background jobs
+app.config['JOB_WORKERS'] = int(os.getenv('JOB_WORKERS', 2))  # uploads organized at the same time
+app.config['JOB_STORE_PATH'] = os.getenv('JOB_STORE_PATH', 'jobs.sqlite3')
+app.config['JOB_HEARTBEAT_SECONDS'] = float(os.getenv('JOB_HEARTBEAT_SECONDS', 10))  # how often a server records its jobs are alive
+app.config['JOB_STALE_SECONDS'] = float(os.getenv('JOB_STALE_SECONDS', 120))  # unfinished jobs without a heartbeat this long are failed
+app.config['JOB_RETENTION_DAYS'] = float(os.getenv('JOB_RETENTION_DAYS', 7))  # finished jobs are pruned after this
+app.config['JOB_EVENTS_MAX_SECONDS'] = float(os.getenv('JOB_EVENTS_MAX_SECONDS', 300))  # SSE streams end after this; browsers reconnect
+app.config['CATALOG_PATH'] = os.getenv('CATALOG_PATH', 'catalog.sqlite3')  # organized files by content hash
+app.config['UPLOAD_CHUNK_SIZE'] = 1024 * 1024
+app.config['UPLOAD_SESSION_CHUNK_SIZE'] = int(os.getenv('UPLOAD_SESSION_CHUNK_SIZE', 8 * 1024 * 1024))  # bytes per chunk of a resumable upload
+app.config['UPLOAD_SESSION_MAX_BYTES'] = int(os.getenv('UPLOAD_SESSION_MAX_BYTES', 10 * 1024 ** 3))  # total size of one resumable upload
+app.config['UPLOAD_SESSION_TTL_HOURS'] = float(os.getenv('UPLOAD_SESSION_TTL_HOURS', 24))  # unfinished uploads are discarded after this
+app.config['PREVIEW_SNIPPET_CHARS'] = 500
+app.config['PREVIEW_CACHE_FOLDER'] = os.getenv('PREVIEW_CACHE_FOLDER', 'preview_cache')  # image thumbnails
+app.config['PREVIEW_CACHE_MAX_BYTES'] = int(os.getenv('PREVIEW_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+app.config['THUMBNAIL_SIZE'] = 256
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf', 'docx', 'csv'}
 SUPPORTED_IMAGES = {'.png', '.jpg', '.jpeg'}
 SUPPORTED_DOCS = {'.pdf', '.docx', '.csv'}
 
-# Initialize OpenAI client with API key from .env
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# Formats that are already compressed are stored as-is in ZIP exports
+STORED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.pdf', '.docx'}
+
+ANALYSIS_MODEL = "gpt-3.5-turbo"
+ANALYSIS_PROMPT_VERSION = 1  # Bump whenever the analysis prompt changes to invalidate cached results
+ANALYSIS_SYSTEM_PROMPT = """You are a document analyzer. Analyze the content and suggest appropriate categorization. 
+                Rules:
+                1. Response must be valid JSON
+                2. Include:
+                   - 'category' (broad category like 'Education', 'Language', 'Mathematics', 'Personal')
+                   - 'subcategory' (general grouping like 'Assignments', 'Course_Materials', 'Exercises')
+                   - 'keywords' (list of 3-5 key terms found in content)
+                3. Use broad, inclusive categories to group related content together
+                4. Similar content should be grouped in the same subcategory
+                5. Avoid overly specific categorization"""
+BATCH_SYSTEM_PROMPT = ANALYSIS_SYSTEM_PROMPT + """
+                6. You will receive several documents, each starting with a line '### Document <id>'
+                7. Respond with a JSON object {"results": [...]} holding one entry per document with
+                   its 'id' plus the 'category', 'subcategory' and 'keywords' described above"""
+
+UNCATEGORIZED = {'category': 'Uncategorized', 'subcategory': 'Other', 'keywords': []}
+
+MINHASH_PERMUTATIONS = 128
+MINHASH_BANDS = 16  # 8 rows per band: pairs above ~0.7 similarity almost always share a band
+MINHASH_SHINGLE_WORDS = 3
+MINHASH_MIN_SHINGLES = 20  # shorter texts are too small to call near-duplicates
+MERSENNE_PRIME = (1 << 61) - 1
+
+EXTRACTION_MODULES = ('PyPDF2', 'docx')
+HEAVY_MODULES = EXTRACTION_MODULES + (
+    'numpy', 'scipy.cluster.hierarchy', 'scipy.spatial.distance',
+    'sklearn.feature_extraction.text', 'sklearn.metrics.pairwise', 'openai', 'PIL.Image',
+)
+
+# OpenAI client, created with the API key from .env on first use
+client = None
+_client_lock = threading.Lock()
+
+def get_openai_client():
+    """Return the shared OpenAI client, creating it on first use."""
+    global client
+    with _client_lock:
+        if client is None:
+            from openai import OpenAI
+            # Retries are handled by create_chat_completion
+            client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+        return client
+
+def preload_dependencies(modules=HEAVY_MODULES):
+    """Import heavy modules now instead of on first use."""
+    for module in modules:
+        importlib.import_module(module)
+
+if os.getenv('PRELOAD_DEPENDENCIES') == '1':
+    preload_dependencies()
+
+class Metrics:
+    """Thread-safe counters and histograms rendered in the Prometheus text format.
+
+    Values are per process; with several gunicorn workers each reports its own.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}  # name -> (kind, help)
+        self._counters = defaultdict(float)  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+
+    def describe(self, name, kind, help_text):
+        self._metrics[name] = (kind, help_text)
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def value(self, name, **labels):
+        """Return a counter value, or a histogram's observation count."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key][2]
+            return self._counters.get(key, 0)
+
+    def render(self):
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in sorted(self._metrics.items()):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                if kind == 'counter':
+                    for (metric, labels), value in sorted(self._counters.items()):
+                        if metric == name:
+                            lines.append(f'{name}{fmt(labels)} {value:g}')
+                else:
+                    for (metric, labels), (buckets, total, count) in sorted(self._histograms.items()):
+                        if metric != name:
+                            continue
+                        for bound, bucket_count in zip(self.BUCKETS, buckets):
+                            lines.append(f'{name}_bucket{fmt(labels, [("le", f"{bound:g}")])} {bucket_count}')
+                        lines.append(f'{name}_bucket{fmt(labels, [("le", "+Inf")])} {count}')
+                        lines.append(f'{name}_sum{fmt(labels)} {total:g}')
+                        lines.append(f'{name}_count{fmt(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('organizer_stage_seconds', 'histogram',
+                 'Time per file in the extract and move stages and per OpenAI request in the classify stage')
+metrics.describe('organizer_batch_seconds', 'histogram', 'Time to organize one upload batch')
+metrics.describe('organizer_files_total', 'counter', 'Files organized by type, including skipped duplicates')
+metrics.describe('organizer_extract_timeouts_total', 'counter', 'Documents whose text extraction timed out')
+metrics.describe('organizer_llm_requests_total', 'counter', 'OpenAI requests by kind and outcome')
+metrics.describe('organizer_llm_tokens_total', 'counter', 'OpenAI tokens used by type')
+metrics.describe('organizer_llm_cache_total', 'counter', 'Analysis cache lookups by result')
+metrics.describe('organizer_llm_retries_total', 'counter', 'OpenAI requests retried after a transient error')
+metrics.describe('organizer_llm_hedges_total', 'counter', 'Duplicate OpenAI requests sent for slow responses')
+metrics.describe('organizer_llm_breaker_trips_total', 'counter', 'Times the OpenAI circuit breaker opened')
+metrics.describe('organizer_llm_fallbacks_total', 'counter', 'Documents classified locally because OpenAI was unavailable')
+metrics.describe('organizer_category_matches_total', 'counter',
+                 'Documents placed in an existing folder by nearest centroid instead of analysis')
+metrics.describe('organizer_category_renames_total', 'counter',
+                 'Analyzed category names mapped onto an existing folder')
+metrics.describe('organizer_near_duplicates_total', 'counter',
+                 'Documents that inherited the category of a near-duplicate instead of being analyzed')
+
+@contextmanager
+def timed(timings=None, key=None, metric=None, **labels):
+    """Time a block into metrics and/or add its seconds to timings[key]."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if metric:
+            metrics.observe(metric, elapsed, **labels)
+        if timings is not None:
+            timings[key] = timings.get(key, 0.0) + elapsed
+
+def record_llm_usage(response, kind):
+    """Count a successful OpenAI response and the tokens it reports."""
+    metrics.inc('organizer_llm_requests_total', kind=kind, outcome='success')
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        metrics.inc('organizer_llm_tokens_total', getattr(usage, 'prompt_tokens', 0) or 0, type='prompt')
+        metrics.inc('organizer_llm_tokens_total', getattr(usage, 'completion_tokens', 0) or 0, type='completion')
+
+class RateLimiter:
+    """Sliding one-minute window pacing requests and estimated tokens per minute."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = deque()  # (timestamp, tokens)
+
+    def acquire(self, tokens, requests_per_minute=0, tokens_per_minute=0, blocking=True):
+        """Block until one more request of `tokens` fits in both limits.
+
+        With blocking=False, returns False instead of waiting.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0][0] >= 60:
+                    self._calls.popleft()
+
+                used_tokens = sum(t for _, t in self._calls)
+                rpm_ok = not requests_per_minute or len(self._calls) < requests_per_minute
+                # A single request larger than the whole budget is let through on an empty window
+                tpm_ok = (not tokens_per_minute or not self._calls
+                          or used_tokens + tokens <= tokens_per_minute)
+                if rpm_ok and tpm_ok:
+                    self._calls.append((now, tokens))
+                    return True
+                if not blocking:
+                    return False
+                wait = 60 - (now - self._calls[0][0])
+            time.sleep(max(wait, 0.01))
+
+llm_rate_limiter = RateLimiter()
+
+class CircuitBreaker:
+    """Fails fast after consecutive failures, letting one trial call through after a cooldown."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def allow(self, cooldown):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self._trial and time.monotonic() - self.opened_at >= cooldown:
+                self._trial = True  # half-open: this call decides whether to close again
+                return True
+            return False
+
+    def record(self, success, threshold):
+        with self._lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                self._trial = False
+                return
+            self.failures += 1
+            if self._trial or (self.opened_at is None and self.failures >= threshold):
+                self.opened_at = time.monotonic()
+                self._trial = False
+                metrics.inc('organizer_llm_breaker_trips_total')
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self.opened_at is not None
+
+class LatencyWindow:
+    """Recent request latencies, for picking a hedging delay."""
+
+    def __init__(self, size=200, min_samples=20):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, pct):
+        """Nearest-rank percentile, or None until min_samples latencies are recorded."""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(math.ceil(pct / 100 * len(ordered))) - 1)]
+
+llm_breaker = CircuitBreaker()
+llm_latency = LatencyWindow()
+
+class AnalysisCache:
+    """SQLite-backed cache of analysis results keyed by content hash, with LRU and age eviction."""
+
+    def __init__(self, path, max_entries=50000, max_age_days=90):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS analyses (
+            key TEXT PRIMARY KEY,
+            result TEXT NOT NULL,
+            created REAL NOT NULL,
+            last_used REAL NOT NULL)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS analyses_last_used ON analyses (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(text, model=ANALYSIS_MODEL, prompt_version=ANALYSIS_PROMPT_VERSION):
+        digest = hashlib.sha256()
+        digest.update(f"{model}\0{prompt_version}\0".encode('utf-8'))
+        digest.update(text.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM analyses WHERE key = ? AND created > ?",
+                (key, now - self.max_age)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE analyses SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key, result):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO analyses (key, result, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(result), now, now)
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM analyses WHERE created <= ?", (now - self.max_age,))
+        self._conn.execute(
+            """DELETE FROM analyses WHERE key IN (
+                SELECT key FROM analyses ORDER BY last_used DESC LIMIT -1 OFFSET ?)""",
+            (self.max_entries,)
+        )
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM analyses").fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+_analysis_cache = None
+_analysis_cache_lock = threading.Lock()
+
+def get_analysis_cache():
+    """Return the analysis cache for the configured path, or None when caching is disabled."""
+    global _analysis_cache
+    path = app.config['ANALYSIS_CACHE_PATH']
+    if not path:
+        return None
+    with _analysis_cache_lock:
+        if _analysis_cache is None or _analysis_cache.path != path:
+            _analysis_cache = AnalysisCache(
+                path,
+                app.config['ANALYSIS_CACHE_MAX_ENTRIES'],
+                app.config['ANALYSIS_CACHE_MAX_AGE_DAYS'],
+            )
+        return _analysis_cache
+
+class CategoryIndex:
+    """Per-folder centroids of hashed term vectors, persisted in SQLite and updated incrementally.
+
+    Each (category, subcategory) keeps the sum of its documents' L2-normalized
+    term vectors, trimmed to the heaviest max_terms features, plus a count of the
+    keywords its documents were given. Centroids are held in memory and reloaded
+    when another process commits.
+    """
+
+    N_FEATURES = 2 ** 20
+
+    def __init__(self, path, max_terms=2000):
+        self.path = path
+        self.max_terms = max_terms
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS centroids (
+            category TEXT NOT NULL,
+            subcategory TEXT NOT NULL,
+            documents INTEGER NOT NULL,
+            vector TEXT NOT NULL,
+            keywords TEXT NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (category, subcategory))""")
+        self._conn.commit()
+        self._version = None
+        self._centroids = {}
+
+    @classmethod
+    def vectorize(cls, text):
+        """Return text as an L2-normalized {feature: weight} dict of hashed terms."""
+        from sklearn.feature_extraction.text import HashingVectorizer
+
+        row = HashingVectorizer(
+            n_features=cls.N_FEATURES, stop_words='english', alternate_sign=False
+        ).transform([text])
+        return {int(i): float(v) for i, v in zip(row.indices, row.data)}
+
+    def _refresh(self):
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._version:
+            return
+        self._version = version
+        self._centroids = {}
+        rows = self._conn.execute("SELECT category, subcategory, documents, vector, keywords FROM centroids")
+        for category, subcategory, documents, vector, keywords in rows:
+            vector = {int(i): v for i, v in json.loads(vector).items()}
+            self._centroids[(category, subcategory)] = {
+                'documents': documents,
+                'vector': vector,
+                'norm': math.sqrt(sum(v * v for v in vector.values())),
+                'keywords': json.loads(keywords)
+            }
+
+    def folders(self):
+        """Return {category: set of subcategories} for every folder with a centroid."""
+        with self._lock:
+            self._refresh()
+            folders = defaultdict(set)
+            for category, subcategory in self._centroids:
+                folders[category].add(subcategory)
+        return folders
+
+    def nearest(self, text, min_documents=1):
+        """Return [(similarity, (category, subcategory)), ...] for text, best first."""
+        with self._lock:
+            self._refresh()
+            candidates = [(key, centroid) for key, centroid in self._centroids.items()
+                          if centroid['documents'] >= min_documents and centroid['norm']]
+        if not candidates:
+            return []
+        vector = self.vectorize(text)
+        scores = []
+        with self._lock:
+            for key, centroid in candidates:
+                weights = centroid['vector']
+                dot = sum(weight * weights.get(term, 0.0) for term, weight in vector.items())
+                scores.append((dot / centroid['norm'], key))
+        scores.sort(reverse=True)
+        return scores
+
+    def keywords(self, key, limit=5):
+        with self._lock:
+            counts = self._centroids.get(key, {}).get('keywords', {})
+            return sorted(counts, key=lambda keyword: -counts[keyword])[:limit]
+
+    def add(self, entries):
+        """Fold [(category, subcategory, text, keywords), ...] into their centroids."""
+        now = time.time()
+        with self._lock:
+            self._refresh()
+            touched = set()
+            for category, subcategory, text, keywords in entries:
+                key = (category, subcategory)
+                centroid = self._centroids.setdefault(
+                    key, {'documents': 0, 'vector': {}, 'norm': 0.0, 'keywords': {}}
+                )
+                centroid['documents'] += 1
+                for term, weight in self.vectorize(text).items():
+                    centroid['vector'][term] = centroid['vector'].get(term, 0.0) + weight
+                for keyword in keywords:
+                    centroid['keywords'][keyword] = centroid['keywords'].get(keyword, 0) + 1
+                touched.add(key)
+            for key in touched:
+                centroid = self._centroids[key]
+                if len(centroid['vector']) > self.max_terms:
+                    heaviest = sorted(centroid['vector'].items(), key=lambda item: -item[1])[:self.max_terms]
+                    centroid['vector'] = dict(heaviest)
+                centroid['norm'] = math.sqrt(sum(v * v for v in centroid['vector'].values()))
+                self._conn.execute(
+                    """INSERT OR REPLACE INTO centroids (category, subcategory, documents, vector, keywords, updated)
+                       VALUES (?, ?, ?, ?, ?, ?)""",
+                    (key[0], key[1], centroid['documents'], json.dumps(centroid['vector']),
+                     json.dumps(centroid['keywords']), now)
+                )
+            self._conn.commit()
+
+_category_index = None
+_category_index_lock = threading.Lock()
+
+def get_category_index():
+    """Return the category index for the configured path, or None when matching is disabled."""
+    global _category_index
+    path = app.config['CATEGORY_INDEX_PATH']
+    if not path:
+        return None
+    with _category_index_lock:
+        if _category_index is None or _category_index.path != path:
+            _category_index = CategoryIndex(path, app.config['CATEGORY_CENTROID_TERMS'])
+        return _category_index
+
+def _minhash_coefficients():
+    """Fixed (a, b) pairs for the MinHash permutations; signatures are persisted, so they must never change."""
+    import numpy as np
+
+    values = [
+        int.from_bytes(hashlib.sha256(f"minhash{i}".encode('utf-8')).digest()[:8], 'big')
+        for i in range(MINHASH_PERMUTATIONS)
+    ]
+    a = np.array([(value >> 32) | 1 for value in values], dtype=np.uint64)
+    b = np.array([value & 0xFFFFFFFF for value in values], dtype=np.uint64)
+    return a, b
+
+def minhash_signature(text):
+    """Return the MinHash signature of text's word shingles, or None when text is too short."""
+    words = re.findall(r'\w+', text.lower())
+    shingles = {' '.join(words[i:i + MINHASH_SHINGLE_WORDS]) for i in range(len(words) - MINHASH_SHINGLE_WORDS + 1)}
+    if len(shingles) < MINHASH_MIN_SHINGLES:
+        return None
+    import numpy as np
+
+    hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles),
+                         dtype=np.uint64, count=len(shingles))
+    a, b = _minhash_coefficients()
+    # a, b and the hashes are below 2**32, so a * x + b cannot overflow 64 bits
+    permuted = (np.outer(hashes, a) + b) % np.uint64(MERSENNE_PRIME)
+    return (permuted.min(axis=0) & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+
+def minhash_similarity(signature, other):
+    """Estimated Jaccard similarity of the texts behind two signatures."""
+    return float((signature == other).mean())
+
+class NearDuplicateIndex:
+    """MinHash signatures of classified documents with an LSH band index, persisted in SQLite.
+
+    Each signature is split into MINHASH_BANDS bands; documents sharing any band
+    bucket are candidates, and candidates are ranked by estimated similarity.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS documents (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            analysis TEXT NOT NULL,
+            signature BLOB NOT NULL)""")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS buckets (
+            bucket INTEGER NOT NULL,
+            document INTEGER NOT NULL)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS buckets_bucket ON buckets (bucket)")
+        self._conn.commit()
+
+    @staticmethod
+    def buckets(signature):
+        rows = len(signature) // MINHASH_BANDS
+        return [
+            int.from_bytes(
+                hashlib.blake2b(bytes([band]) + signature[band * rows:(band + 1) * rows].tobytes(),
+                                digest_size=8).digest(),
+                'big', signed=True
+            )
+            for band in range(MINHASH_BANDS)
+        ]
+
+    def query(self, signature):
+        """Return [(similarity, path, analysis), ...] for documents sharing a band with signature, best first."""
+        import numpy as np
+
+        buckets = self.buckets(signature)
+        with self._lock:
+            rows = self._conn.execute(
+                f"""SELECT path, analysis, signature FROM documents WHERE id IN (
+                    SELECT document FROM buckets WHERE bucket IN ({','.join('?' * len(buckets))}))""",
+                buckets
+            ).fetchall()
+        matches = [
+            (minhash_similarity(signature, np.frombuffer(blob, dtype=np.uint32)), path, json.loads(analysis))
+            for path, analysis, blob in rows
+        ]
+        matches.sort(key=lambda match: -match[0])
+        return matches
+
+    def add(self, entries):
+        """Index [(path, signature, analysis), ...]."""
+        with self._lock:
+            for path, signature, analysis in entries:
+                cursor = self._conn.execute(
+                    "INSERT INTO documents (path, analysis, signature) VALUES (?, ?, ?)",
+                    (path, json.dumps(analysis), signature.tobytes())
+                )
+                self._conn.executemany(
+                    "INSERT INTO buckets (bucket, document) VALUES (?, ?)",
+                    [(bucket, cursor.lastrowid) for bucket in self.buckets(signature)]
+                )
+            self._conn.commit()
+
+_near_duplicate_index = None
+_near_duplicate_index_lock = threading.Lock()
+
+def get_near_duplicate_index():
+    """Return the near-duplicate index for the configured path, or None when detection is disabled."""
+    global _near_duplicate_index
+    path = app.config['NEAR_DUPLICATE_INDEX_PATH']
+    if not path:
+        return None
+    with _near_duplicate_index_lock:
+        if _near_duplicate_index is None or _near_duplicate_index.path != path:
+            _near_duplicate_index = NearDuplicateIndex(path)
+        return _near_duplicate_index
+
+class JobStore:
+    """SQLite-backed upload job status shared by every worker process."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            created REAL NOT NULL,
+            updated REAL NOT NULL,
+            files TEXT NOT NULL,
+            stats TEXT,
+            error TEXT,
+            worker TEXT,
+            heartbeat REAL)""")
+        self._conn.commit()
+
+    def create(self, job_id, filenames, worker=None):
+        now = time.time()
+        files = {name: 'queued' for name in filenames}
+        with self._lock:
+            self._conn.execute(
+                """INSERT INTO jobs (id, status, created, updated, files, worker, heartbeat)
+                   VALUES (?, 'queued', ?, ?, ?, ?, ?)""",
+                (job_id, now, now, json.dumps(files), worker, now)
+            )
+            self._conn.commit()
+
+    def heartbeat(self, worker):
+        """Record that the server process `worker` is still running its unfinished jobs."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET heartbeat = ? WHERE worker = ? AND status IN ('queued', 'running')",
+                (time.time(), worker)
+            )
+            self._conn.commit()
+
+    def expire(self, stale_before, finished_before):
+        """Fail unfinished jobs whose worker stopped sending heartbeats, and prune old finished jobs."""
+        with self._lock:
+            self._conn.execute(
+                """UPDATE jobs SET status = 'failed', error = 'Job interrupted: its server stopped responding',
+                   updated = ? WHERE status IN ('queued', 'running') AND COALESCE(heartbeat, updated) < ?""",
+                (time.time(), stale_before)
+            )
+            self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('completed', 'failed') AND updated < ?", (finished_before,)
+            )
+            self._conn.commit()
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, status, created, updated, files, stats, error FROM jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        files = json.loads(row[4])
+        return {
+            'job_id': row[0],
+            'status': row[1],
+            'created': row[2],
+            'updated': row[3],
+            'files': files,
+            'progress': {
+                'done': sum(1 for status in files.values() if status in ('organized', 'duplicate')),
+                'total': len(files)
+            },
+            'stats': json.loads(row[5]) if row[5] else None,
+            'error': row[6]
+        }
+
+    def update(self, job_id, status=None, stats=None, error=None):
+        with self._lock:
+            self._conn.execute(
+                """UPDATE jobs SET status = COALESCE(?, status), stats = COALESCE(?, stats),
+                   error = COALESCE(?, error), updated = ? WHERE id = ?""",
+                (status, json.dumps(stats) if stats is not None else None, error, time.time(), job_id)
+            )
+            self._conn.commit()
+
+    def update_file(self, job_id, filename, status):
+        with self._lock:
+            row = self._conn.execute("SELECT files FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return
+            files = json.loads(row[0])
+            files[filename] = status
+            self._conn.execute(
+                "UPDATE jobs SET files = ?, updated = ? WHERE id = ?",
+                (json.dumps(files), time.time(), job_id)
+            )
+            self._conn.commit()
+
+class UploadSessionStore:
+    """SQLite record of resumable uploads and the chunks received so far.
+
+    Sessions live in the job store's database and share their id with the job
+    that organizes them once every chunk has arrived.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            created REAL NOT NULL,
+            updated REAL NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            files TEXT NOT NULL)""")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS upload_chunks (
+            upload_id TEXT NOT NULL,
+            file INTEGER NOT NULL,
+            chunk INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            PRIMARY KEY (upload_id, file, chunk))""")
+        self._conn.commit()
+
+    def create(self, upload_id, chunk_size, files):
+        """Record a new session; files is a list of {'name', 'path', 'size', 'sha256'} dicts."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                """INSERT INTO upload_sessions (id, status, created, updated, chunk_size, files)
+                   VALUES (?, 'open', ?, ?, ?, ?)""",
+                (upload_id, now, now, chunk_size, json.dumps(files))
+            )
+            self._conn.commit()
+
+    def get(self, upload_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, status, created, updated, chunk_size, files FROM upload_sessions WHERE id = ?",
+                (upload_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            received = defaultdict(set)
+            for index, chunk in self._conn.execute(
+                "SELECT file, chunk FROM upload_chunks WHERE upload_id = ?", (upload_id,)
+            ):
+                received[index].add(chunk)
+        files = json.loads(row[5])
+        for index, entry in enumerate(files):
+            entry['chunks'] = chunk_count(entry['size'], row[4])
+            entry['missing'] = [chunk for chunk in range(entry['chunks']) if chunk not in received[index]]
+        return {
+            'upload_id': row[0],
+            'status': row[1],
+            'created': row[2],
+            'updated': row[3],
+            'chunk_size': row[4],
+            'files': files
+        }
+
+    def add_chunk(self, upload_id, index, chunk, digest):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO upload_chunks (upload_id, file, chunk, sha256) VALUES (?, ?, ?, ?)",
+                (upload_id, index, chunk, digest)
+            )
+            self._conn.execute("UPDATE upload_sessions SET updated = ? WHERE id = ?", (time.time(), upload_id))
+            self._conn.commit()
+
+    def close(self, upload_id):
+        """Mark an open session complete; False if another request already did."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE upload_sessions SET status = 'completed', updated = ? WHERE id = ? AND status = 'open'",
+                (time.time(), upload_id)
+            )
+            self._conn.execute("DELETE FROM upload_chunks WHERE upload_id = ?", (upload_id,))
+            self._conn.commit()
+        return cursor.rowcount == 1
+
+    def expire(self, cutoff):
+        """Delete sessions untouched since cutoff, returning the ids of those never completed."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, status FROM upload_sessions WHERE updated < ?", (cutoff,)
+            ).fetchall()
+            for upload_id, _ in rows:
+                self._conn.execute("DELETE FROM upload_chunks WHERE upload_id = ?", (upload_id,))
+                self._conn.execute("DELETE FROM upload_sessions WHERE id = ?", (upload_id,))
+            self._conn.commit()
+        return [upload_id for upload_id, status in rows if status == 'open']
+
+class FileCatalog:
+    """SQLite record of every organized file, keyed by its path relative to ORGANIZED_FOLDER.
+
+    An FTS5 table alongside it indexes each file's name, extracted text and
+    keywords for BM25-ranked search.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            hash TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            subcategory TEXT,
+            keywords TEXT NOT NULL,
+            created REAL NOT NULL,
+            snippet TEXT)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS files_hash ON files (hash)")
+        # Index rows share their rowid with the files table so updates are indexed lookups
+        self._conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+            name, body, keywords, tokenize = 'porter unicode61')""")
+        self._conn.commit()
+
+    def _index(self, rowid, path, text, keywords):
+        name = re.sub(r'[_\W]+', ' ', os.path.splitext(os.path.basename(path))[0])
+        self._conn.execute(
+            "INSERT INTO files_fts (rowid, name, body, keywords) VALUES (?, ?, ?, ?)",
+            (rowid, name, text, ' '.join(str(keyword) for keyword in keywords))
+        )
+
+    def _unindex(self, path):
+        row = self._conn.execute("SELECT rowid FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None:
+            self._conn.execute("DELETE FROM files_fts WHERE rowid = ?", (row[0],))
+
+    def add(self, path, digest, size, category, subcategory=None, keywords=(), snippet=None, text=None):
+        with self._lock:
+            self._unindex(path)
+            cursor = self._conn.execute(
+                """INSERT OR REPLACE INTO files (path, hash, size, category, subcategory, keywords, created, snippet)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (path, digest, size, category, subcategory, json.dumps(list(keywords)), time.time(), snippet)
+            )
+            self._index(cursor.lastrowid, path, text if text is not None else snippet or '', keywords)
+            self._conn.commit()
+
+    def search(self, query, category=None, subcategory=None, limit=20):
+        """Return catalog entries matching every term in query, best BM25 score first."""
+        terms = re.findall(r'\w+', query.lower())
+        if not terms:
+            return []
+        sql = """SELECT f.path, f.category, f.subcategory, f.keywords,
+                        bm25(files_fts, 2.0, 1.0, 3.0) AS score,
+                        snippet(files_fts, 1, '[', ']', '...', 16)
+                 FROM files_fts JOIN files f ON f.rowid = files_fts.rowid
+                 WHERE files_fts MATCH ?"""
+        params = [' '.join(f'"{term}"' for term in terms)]
+        if category:
+            sql += " AND f.category = ?"
+            params.append(category)
+        if subcategory:
+            sql += " AND f.subcategory = ?"
+            params.append(subcategory)
+        sql += " ORDER BY score LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [{
+            'path': row[0],
+            'category': row[1],
+            'subcategory': row[2],
+            'keywords': json.loads(row[3]),
+            'score': round(-row[4], 4),
+            'snippet': row[5]
+        } for row in rows]
+
+    def get(self, path):
+        with self._lock:
+            row = self._conn.execute(
+                """SELECT path, hash, size, category, subcategory, keywords, created, snippet
+                   FROM files WHERE path = ?""", (path,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            'path': row[0],
+            'hash': row[1],
+            'size': row[2],
+            'category': row[3],
+            'subcategory': row[4],
+            'keywords': json.loads(row[5]),
+            'created': row[6],
+            'snippet': row[7]
+        }
+
+    def list_folder(self, folder):
+        """Return (path, size) of every file under folder, using the path index."""
+        prefix = folder.rstrip('/') + '/'
+        with self._lock:
+            return self._conn.execute(
+                # '0' sorts right after '/', so this range is exactly the paths under prefix
+                "SELECT path, size FROM files WHERE path >= ? AND path < ? ORDER BY path",
+                (prefix, prefix[:-1] + '0')
+            ).fetchall()
+
+    def find_by_hash(self, digest):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path FROM files WHERE hash = ? ORDER BY created", (digest,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def remove(self, path):
+        with self._lock:
+            self._unindex(path)
+            self._conn.execute("DELETE FROM files WHERE path = ?", (path,))
+            self._conn.commit()
+
+_catalog = None
+_job_store = None
+_upload_sessions = None
+_job_executor = None
+_job_worker = None  # (pid, id) of the process whose heartbeat thread is running
+_jobs_expired_at = float('-inf')
+_job_lock = threading.Lock()
+
+def get_job_store():
+    """Return the job store for the configured path."""
+    global _job_store
+    path = app.config['JOB_STORE_PATH']
+    with _job_lock:
+        if _job_store is None or _job_store.path != path:
+            _job_store = JobStore(path)
+        return _job_store
+
+def get_upload_sessions():
+    """Return the resumable upload store, kept in the job store's database."""
+    global _upload_sessions
+    path = app.config['JOB_STORE_PATH']
+    with _job_lock:
+        if _upload_sessions is None or _upload_sessions.path != path:
+            _upload_sessions = UploadSessionStore(path)
+        return _upload_sessions
+
+def job_worker_id():
+    """Return the id this process records on its jobs, starting its heartbeat thread on first use.
+
+    The id is per process, so forked servers each get their own.
+    """
+    global _job_worker
+    with _job_lock:
+        if _job_worker is None or _job_worker[0] != os.getpid():
+            _job_worker = (os.getpid(), uuid.uuid4().hex)
+            threading.Thread(target=_send_job_heartbeats, args=(_job_worker[1],),
+                             name='job-heartbeat', daemon=True).start()
+        return _job_worker[1]
+
+def _send_job_heartbeats(worker):
+    while True:
+        time.sleep(app.config['JOB_HEARTBEAT_SECONDS'])
+        try:
+            get_job_store().heartbeat(worker)
+        except Exception as e:
+            print(f"Error recording job heartbeat: {str(e)}")
+
+def expire_jobs():
+    """Fail jobs whose server went away and prune old ones, at most once per heartbeat interval."""
+    global _jobs_expired_at
+    now = time.monotonic()
+    with _job_lock:
+        if now - _jobs_expired_at < app.config['JOB_HEARTBEAT_SECONDS']:
+            return
+        _jobs_expired_at = now
+    get_job_store().expire(time.time() - app.config['JOB_STALE_SECONDS'],
+                           time.time() - app.config['JOB_RETENTION_DAYS'] * 86400)
+
+def get_catalog():
+    """Return the file catalog for the configured path."""
+    global _catalog
+    path = app.config['CATALOG_PATH']
+    with _job_lock:
+        if _catalog is None or _catalog.path != path:
+            _catalog = FileCatalog(path)
+        return _catalog
+
+def get_job_executor():
+    """Return the background pool that runs upload jobs."""
+    global _job_executor
+    with _job_lock:
+        if _job_executor is None:
+            _job_executor = ThreadPoolExecutor(
+                max_workers=max(1, app.config['JOB_WORKERS']), thread_name_prefix='upload-job'
+            )
+        return _job_executor
+
+def estimate_tokens(text):
+    """Rough token count for pacing (about 4 characters per token)."""
+    return len(text) // 4 + 1
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def extract_words_from_file(filepath):
-    """Extract text content from supported document types."""
+def save_upload(file, filepath, chunk_size=1024 * 1024):
+    """Stream an uploaded file to disk in chunks, returning its sha256 hex digest."""
+    digest = hashlib.sha256()
+    with open(filepath, 'wb') as out:
+        while True:
+            chunk = file.stream.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest()
+
+def file_digest(filepath, chunk_size=1024 * 1024):
+    """Return the sha256 hex digest of a file on disk."""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def chunk_count(size, chunk_size):
+    """Number of chunks a file of size bytes is sent in."""
+    return -(-size // chunk_size)
+
+def write_chunk(filepath, offset, stream, length, read_size=1024 * 1024):
+    """Copy length bytes from stream into filepath at offset, returning their sha256 hex digest.
+
+    Returns None if the stream ends early. The file must already exist, so
+    chunks of the same file can be written by concurrent requests.
+    """
+    digest = hashlib.sha256()
+    remaining = length
+    with open(filepath, 'r+b') as out:
+        out.seek(offset)
+        while remaining:
+            chunk = stream.read(min(read_size, remaining))
+            if not chunk:
+                return None
+            digest.update(chunk)
+            out.write(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+def make_snippet(text):
+    """Collapse whitespace and cut text down to a preview snippet."""
+    return " ".join(text.split())[:app.config['PREVIEW_SNIPPET_CHARS']]
+
+def cached_thumbnail(filepath, digest):
+    """Return the path of a JPEG thumbnail for an image, generating it on first use.
+
+    Thumbnails live in PREVIEW_CACHE_FOLDER named by content hash; the least
+    recently used ones are deleted once the folder exceeds PREVIEW_CACHE_MAX_BYTES.
+    """
+    from PIL import Image
+
+    cache_folder = app.config['PREVIEW_CACHE_FOLDER']
+    thumbnail = os.path.join(cache_folder, f"{digest}.jpg")
+    if os.path.exists(thumbnail):
+        os.utime(thumbnail)  # mark as recently used
+        return thumbnail
+
+    os.makedirs(cache_folder, exist_ok=True)
+    size = app.config['THUMBNAIL_SIZE']
+    with Image.open(filepath) as image:
+        image.thumbnail((size, size))
+        temp_path = f"{thumbnail}.{uuid.uuid4().hex}.tmp"
+        image.convert('RGB').save(temp_path, 'JPEG', quality=80)
+    os.replace(temp_path, thumbnail)
+
+    entries = []
+    for name in os.listdir(cache_folder):
+        path = os.path.join(cache_folder, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= app.config['PREVIEW_CACHE_MAX_BYTES'] or path == thumbnail:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+    return thumbnail
+
+class _ZipStream(io.RawIOBase):
+    """Write-only, unseekable sink that hands written bytes back to a generator."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return b''.join(chunks)
+
+def stream_zip(files, chunk_size=64 * 1024):
+    """Yield a ZIP archive of (filepath, arcname) pairs piece by piece.
+
+    Nothing beyond the current chunk is held in memory and no temporary file is
+    written. Already-compressed formats are stored, everything else deflated.
+    """
+    sink = _ZipStream()
+    with zipfile.ZipFile(sink, mode='w', allowZip64=True) as archive:
+        for filepath, arcname in files:
+            try:
+                info = zipfile.ZipInfo.from_file(filepath, arcname)
+            except FileNotFoundError:
+                continue
+            stored = os.path.splitext(filepath)[1].lower() in STORED_EXTENSIONS
+            info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+            with open(filepath, 'rb') as src, \
+                    archive.open(info, 'w', force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as dest:
+                for chunk in iter(lambda: src.read(chunk_size), b''):
+                    dest.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            # Closing the entry writes its data descriptor
+            data = sink.drain()
+            if data:
+                yield data
+    # Closing the archive writes the central directory
+    yield sink.drain()
+
+def move_file(src, folder, filename):
+    """Move src into folder under filename without overwriting anything already there.
+
+    On the same filesystem the move is a hard link plus unlink, so the
+    destination name is claimed atomically; name clashes get a _1, _2... suffix.
+    Returns the final path.
+    """
+    base, ext = os.path.splitext(filename)
+    for attempt in itertools.count():
+        dest = os.path.join(folder, filename if attempt == 0 else f"{base}_{attempt}{ext}")
+        try:
+            os.link(src, dest)
+        except FileExistsError:
+            continue
+        except OSError:  # different filesystem or no hard link support
+            if os.path.exists(dest):
+                continue
+            shutil.move(src, dest)
+            return dest
+        os.unlink(src)
+        return dest
+
+def unused_filename(filename, taken):
+    """Return filename, or the first _1, _2... variant of it, that is not in taken."""
+    base, ext = os.path.splitext(filename)
+    for attempt in itertools.count():
+        candidate = filename if attempt == 0 else f"{base}_{attempt}{ext}"
+        if candidate not in taken:
+            return candidate
+
+def spread_order(count):
+    """Yield indices 0..count-1 coarse to fine so any prefix samples the whole range."""
+    seen = set()
+    parts = 1
+    while len(seen) < count:
+        for part in range(parts):
+            index = part * count // parts
+            if index not in seen:
+                seen.add(index)
+                yield index
+        parts *= 2
+
+def iter_pdf_text(filepath, sampling='head'):
+    """Yield (page_number, text) lazily so unread pages are never parsed."""
+    import PyPDF2
+
+    with open(filepath, 'rb') as f:
+        reader = PyPDF2.PdfReader(f)
+        count = len(reader.pages)
+        order = spread_order(count) if sampling == 'spread' else range(count)
+        for index in order:
+            yield index, reader.pages[index].extract_text() or ""
+
+def iter_docx_text(filepath, sampling='head'):
+    """Yield (paragraph_number, text) for a Word document."""
+    from docx import Document
+
+    paragraphs = Document(filepath).paragraphs
+    order = spread_order(len(paragraphs)) if sampling == 'spread' else range(len(paragraphs))
+    for index in order:
+        yield index, paragraphs[index].text
+
+def iter_csv_text(filepath, sampling='head'):
+    """Yield (row_number, text) while streaming the file; rows are always read from the top."""
+    with open(filepath, 'r', encoding='utf-8') as f:
+        for index, row in enumerate(csv.reader(f)):
+            yield index, " ".join(row)
+
+TEXT_EXTRACTORS = {
+    '.pdf': iter_pdf_text,
+    '.docx': iter_docx_text,
+    '.csv': iter_csv_text,
+}
+
+def take_chars(chunks, max_chars):
+    """Join (position, text) chunks in document order, stopping once max_chars are collected."""
+    taken = []
+    total = 0
+    for position, text in chunks:
+        taken.append((position, text))
+        total += len(text) + 1
+        if total > max_chars:
+            break
+    taken.sort(key=lambda chunk: chunk[0])
+    return " ".join(text for _, text in taken)[:max_chars]
+
+def extract_words_from_file(filepath, max_chars=None, sampling=None):
+    """Extract text content from supported document types.
+
+    Pages, paragraphs or rows are read lazily and extraction stops as soon as
+    max_chars (EXTRACT_MAX_CHARS by default) have been collected. With
+    sampling='spread' PDF pages and DOCX paragraphs are sampled across the whole
+    document instead of taken from the start.
+    """
     try:
         ext = os.path.splitext(filepath)[1].lower()
-        
-        if ext == '.docx':
-            doc = Document(filepath)
-            return " ".join([paragraph.text for paragraph in doc.paragraphs])[:10000]
-        
-        elif ext == '.pdf':
-            with open(filepath, 'rb') as f:
-                reader = PyPDF2.PdfReader(f)
-                text = " ".join([page.extract_text() for page in reader.pages])
-                return text[:10000]
-        
-        elif ext == '.csv':
-            with open(filepath, 'r', encoding='utf-8') as f:
-                reader = csv.reader(f)
-                text = " ".join([" ".join(row) for row in reader])
-                return text[:10000]
-        
-        return ""
+        extractor = TEXT_EXTRACTORS.get(ext)
+        if extractor is None:
+            return ""
+
+        if max_chars is None:
+            max_chars = app.config['EXTRACT_MAX_CHARS']
+        if sampling is None:
+            sampling = app.config['EXTRACT_SAMPLING']
+        return take_chars(extractor(filepath, sampling), max_chars)
+    except ExtractionTimeout:
+        raise
     except Exception as e:
         print(f"Error extracting text from {filepath}: {str(e)}")
         return ""
 
+class ExtractionTimeout(Exception):
+    """Raised inside an extraction worker when a file exceeds EXTRACT_TIMEOUT."""
+
+def _raise_extraction_timeout(signum, frame):
+    raise ExtractionTimeout("timed out")
+
+def extract_with_timeout(filepath, max_chars, sampling, timeout):
+    """Pool worker: extract one file, abandoning it after `timeout` seconds.
+
+    Returns (text, seconds spent).
+    """
+    start = time.perf_counter()
+    use_alarm = timeout > 0 and hasattr(signal, 'SIGALRM')
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_extraction_timeout)
+        signal.alarm(timeout)
+    try:
+        return extract_words_from_file(filepath, max_chars, sampling), time.perf_counter() - start
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+
+class ExtractionPool:
+    """Long-lived extraction worker processes shared by every upload job.
+
+    Workers are started by EXTRACT_START_METHOD (forkserver or spawn) rather than
+    forked from this multithreaded server, so they never inherit a lock another
+    thread was holding.
+    """
+
+    def __init__(self, workers, method):
+        self.workers = workers
+        self.method = method
+        context = multiprocessing.get_context(method)
+        if method == 'forkserver':
+            context.set_forkserver_preload(list(EXTRACTION_MODULES))
+        self._pool = context.Pool(processes=workers)
+        self._lock = threading.Lock()
+        self.outstanding = 0
+        self.last_progress = time.monotonic()
+
+    def submit(self, args, done):
+        """Run extract_with_timeout(*args) in a worker and call done(result, error) when it ends."""
+        def finish(result=None, error=None):
+            with self._lock:
+                self.outstanding -= 1
+                self.last_progress = time.monotonic()
+            done(result, error)
+
+        with self._lock:
+            if not self.outstanding:
+                self.last_progress = time.monotonic()
+            self.outstanding += 1
+        self._pool.apply_async(extract_with_timeout, args, callback=finish,
+                               error_callback=lambda error: finish(error=error))
+
+    def stalled(self, timeout):
+        """True if files are waiting but none has finished for longer than one file may take."""
+        with self._lock:
+            return self.outstanding > 0 and time.monotonic() - self.last_progress > timeout + 5
+
+    def close(self):
+        self._pool.close()
+
+    def terminate(self):
+        self._pool.terminate()
+
+_extract_pool = None
+_extract_pool_lock = threading.Lock()
+
+def get_extract_pool():
+    """Return the shared extraction pool, replacing it if EXTRACT_WORKERS or EXTRACT_START_METHOD changed."""
+    global _extract_pool
+    workers = max(1, app.config['EXTRACT_WORKERS'])
+    method = app.config['EXTRACT_START_METHOD']
+    with _extract_pool_lock:
+        if _extract_pool is None or (_extract_pool.workers, _extract_pool.method) != (workers, method):
+            if _extract_pool is not None:
+                _extract_pool.close()  # lets files already queued on it finish
+            _extract_pool = ExtractionPool(workers, method)
+        return _extract_pool
+
+def retire_extract_pool(pool):
+    """Terminate a pool whose workers are stuck; the next upload starts a fresh one."""
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is pool:
+            _extract_pool = None
+    pool.terminate()
+
+def extract_documents(documents, timings=None):
+    """Yield (doc, text) as each document finishes extracting in the shared process pool.
+
+    Each file gets EXTRACT_TIMEOUT seconds inside its worker. As a backstop, if
+    no file in the pool finishes for longer than that, the workers are assumed
+    stuck and the pool is replaced. Files that time out or fail yield "".
+    With EXTRACT_WORKERS=1 files are extracted in the calling thread, in order and
+    without a timeout: SIGALRM only works on the main thread.
+    Per-file extraction seconds are added to timings['extract'] when given.
+    """
+    max_chars = app.config['EXTRACT_MAX_CHARS']
+    sampling = app.config['EXTRACT_SAMPLING']
+    # Even a single document goes to the pool, since only workers enforce the timeout
+    if app.config['EXTRACT_WORKERS'] <= 1:
+        for doc in documents:
+            with timed(timings, 'extract', 'organizer_stage_seconds', stage='extract'):
+                text = extract_words_from_file(doc, max_chars, sampling)
+            yield doc, text
+        return
+
+    timeout = app.config['EXTRACT_TIMEOUT']
+    finished = queue.Queue()
+    pool = get_extract_pool()
+    for doc in documents:
+        pool.submit((doc, max_chars, sampling, timeout),
+                    lambda result, error, doc=doc: finished.put((doc, result, error)))
+
+    pending = set(documents)
+    while pending:
+        try:
+            doc, result, error = finished.get(timeout=1 if timeout > 0 else None)
+        except queue.Empty:
+            if pool.stalled(timeout):
+                retire_extract_pool(pool)
+                break
+            continue
+        pending.discard(doc)
+        if isinstance(error, ExtractionTimeout):
+            print(f"Error extracting text from {doc}: timed out")
+            metrics.inc('organizer_extract_timeouts_total')
+            yield doc, ""
+        elif error is not None:
+            print(f"Error extracting text from {doc}: {str(error)}")
+            yield doc, ""
+        else:
+            text, seconds = result
+            metrics.observe('organizer_stage_seconds', seconds, stage='extract')
+            if timings is not None:
+                timings['extract'] = timings.get('extract', 0.0) + seconds
+            yield doc, text
+
+    for doc in documents:
+        if doc in pending:
+            print(f"Error extracting text from {doc}: timed out")
+            metrics.inc('organizer_extract_timeouts_total')
+            yield doc, ""
+
+def split_sentences(text, max_words=60):
+    """Split text into sentences, breaking run-on stretches such as table rows into max_words pieces."""
+    sentences = []
+    for piece in re.split(r'(?<=[.!?])\s+|\n+', text):
+        words = piece.split()
+        for start in range(0, len(words), max_words):
+            sentences.append(' '.join(words[start:start + max_words]))
+    return sentences
+
+def excerpt_text(text, token_budget):
+    """Return the sentences most representative of text, in document order, within token_budget.
+
+    Sentences are ranked by TF-IDF cosine similarity to the document's centroid.
+    Repeated sentences such as page headers count once, and sentences that
+    closely repeat one already chosen are skipped.
+    """
+    if estimate_tokens(text) <= token_budget:
+        return text
+    import numpy as np
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    sentences = list(dict.fromkeys(split_sentences(text)))
+    try:
+        matrix = TfidfVectorizer(stop_words='english', sublinear_tf=True).fit_transform(sentences)
+    except ValueError:  # only stopwords or numbers
+        return text[:token_budget * 4]
+    scores = matrix @ np.asarray(matrix.mean(axis=0)).ravel()
+    chosen = []
+    used = 0
+    for index in np.argsort(-scores, kind='stable'):
+        if scores[index] <= 0:
+            break
+        cost = estimate_tokens(sentences[index])
+        if used + cost > token_budget:
+            continue
+        if chosen and (matrix[chosen] @ matrix[index].T).max() > 0.8:
+            continue
+        chosen.append(index)
+        used += cost
+    if not chosen:
+        return text[:token_budget * 4]
+    return ' '.join(sentences[index] for index in sorted(chosen))
+
+def prompt_excerpt(text, max_chars=10000):
+    """Text to send for one document: a PROMPT_TOKEN_BUDGET excerpt, or its first max_chars."""
+    budget = app.config['PROMPT_TOKEN_BUDGET']
+    if not budget:
+        return text[:max_chars]
+    return excerpt_text(text, min(budget, max_chars // 4))
+
+class LLMUnavailable(Exception):
+    """No usable OpenAI response within the deadline, or the circuit breaker is open."""
+
+_llm_executor = None
+_llm_slots = None
+_llm_executor_lock = threading.Lock()
+
+def get_llm_slots():
+    """Return the semaphore capping OpenAI requests in flight across this process at LLM_MAX_CONCURRENCY."""
+    global _llm_slots
+    limit = max(1, app.config['LLM_MAX_CONCURRENCY'])
+    with _llm_executor_lock:
+        if _llm_slots is None or _llm_slots[0] != limit:
+            _llm_slots = (limit, threading.BoundedSemaphore(limit))
+        return _llm_slots[1]
+
+def get_llm_executor():
+    """Return the pool that runs OpenAI requests.
+
+    Requests are only submitted while holding an LLM slot, so one thread per slot
+    means a submitted request never waits in the queue.
+    """
+    global _llm_executor
+    limit = max(1, app.config['LLM_MAX_CONCURRENCY'])
+    with _llm_executor_lock:
+        if _llm_executor is None or _llm_executor[0] != limit:
+            if _llm_executor is not None:
+                _llm_executor[1].shutdown(wait=False)
+            _llm_executor = (limit, ThreadPoolExecutor(max_workers=limit, thread_name_prefix='openai'))
+        return _llm_executor[1]
+
+def is_retryable(error):
+    import openai
+
+    return isinstance(error, (LLMUnavailable, openai.RateLimitError, openai.APITimeoutError,
+                              openai.APIConnectionError, openai.InternalServerError))
+
+def retry_after(error):
+    """Seconds the server asked us to wait, if it said."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after', 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+def pace_chat_request(messages, blocking=True):
+    """Reserve rate limit budget for one request of messages."""
+    return llm_rate_limiter.acquire(
+        estimate_tokens(' '.join(message['content'] for message in messages)),
+        app.config['LLM_REQUESTS_PER_MINUTE'],
+        app.config['LLM_TOKENS_PER_MINUTE'],
+        blocking
+    )
+
+def _send_chat_request(messages, timeout, slots, sent):
+    """Executor task: send one request whose LLM slot the caller acquired, releasing it when done.
+
+    sent is set as the request goes out, which is when its attempt clock starts.
+    """
+    try:
+        sent.set()
+        started = time.perf_counter()
+        with timed(metric='organizer_stage_seconds', stage='classify'):
+            response = get_openai_client().chat.completions.create(
+                model=ANALYSIS_MODEL,
+                messages=messages,
+                response_format={ "type": "json_object" },
+                timeout=timeout
+            )
+        llm_latency.add(time.perf_counter() - started)
+        return response
+    finally:
+        slots.release()
+
+def _drop_unsent(futures, slots):
+    """Cancel requests that have not been sent yet. Requests already sent run until their own timeout."""
+    for future in futures:
+        if future.cancel():
+            slots.release()
+
+def _hedged_chat_request(messages, deadline, slots):
+    """Send one request, plus a duplicate if it outlasts the hedging percentile; first success wins.
+
+    The caller has already paced the first request and acquired its LLM slot. A
+    duplicate is only sent if the rate limits and the slots have room for it
+    right away.
+    """
+    executor = get_llm_executor()
+    timeout = min(app.config['LLM_TIMEOUT'], deadline - time.monotonic())
+    sent = threading.Event()
+    futures = {executor.submit(_send_chat_request, messages, timeout, slots, sent)}
+    if not sent.wait(max(0.0, deadline - time.monotonic())):
+        _drop_unsent(futures, slots)
+        raise LLMUnavailable('request was not sent before the deadline')
+    attempt_end = time.monotonic() + timeout
+    hedge_after = None
+    if app.config['LLM_HEDGE_PERCENTILE']:
+        hedge_after = llm_latency.percentile(app.config['LLM_HEDGE_PERCENTILE'])
+    if hedge_after is not None and hedge_after < timeout:
+        done, _ = wait(futures, timeout=hedge_after)
+        if not done and slots.acquire(blocking=False):
+            if pace_chat_request(messages, blocking=False):
+                metrics.inc('organizer_llm_hedges_total')
+                futures.add(executor.submit(
+                    _send_chat_request, messages, attempt_end - time.monotonic(), slots, threading.Event()
+                ))
+            else:
+                slots.release()
+    error = None
+    while futures:
+        done, futures = wait(futures, timeout=max(0.0, attempt_end - time.monotonic()), return_when=FIRST_COMPLETED)
+        if not done:
+            _drop_unsent(futures, slots)
+            raise LLMUnavailable(f'no response within {timeout:.1f}s')
+        for future in done:
+            if future.exception() is None:
+                _drop_unsent(futures, slots)
+                return future.result()
+            error = future.exception()
+    raise error
+
+def create_chat_completion(messages):
+    """Call chat completions with a deadline, jittered retries, optional hedging and a circuit breaker.
+
+    Raises LLMUnavailable when the breaker is open or the deadline passes, or the
+    last error once retries run out.
+    """
+    config = app.config
+    if not llm_breaker.allow(config['LLM_BREAKER_COOLDOWN']):
+        raise LLMUnavailable('circuit breaker open')
+    deadline = time.monotonic() + config['LLM_DEADLINE']
+    slots = get_llm_slots()
+    for attempt in itertools.count():
+        # Waiting for our own rate limits or a free slot is neither a timeout nor an API failure
+        paced = time.monotonic()
+        pace_chat_request(messages)
+        slots.acquire()
+        deadline += time.monotonic() - paced
+        try:
+            response = _hedged_chat_request(messages, deadline, slots)
+        except Exception as e:
+            if not is_retryable(e) or attempt >= config['LLM_MAX_RETRIES']:
+                llm_breaker.record(False, config['LLM_BREAKER_FAILURES'])
+                raise
+            # Full jitter keeps concurrent callers from retrying in lockstep
+            delay = max(random.uniform(0, min(config['LLM_BACKOFF_MAX'], config['LLM_BACKOFF_BASE'] * 2 ** attempt)),
+                        retry_after(e))
+            if time.monotonic() + delay >= deadline:
+                llm_breaker.record(False, config['LLM_BREAKER_FAILURES'])
+                raise LLMUnavailable(f'deadline reached after {attempt + 1} attempts: {str(e)}')
+            metrics.inc('organizer_llm_retries_total')
+            time.sleep(delay)
+            continue
+        llm_breaker.record(True, config['LLM_BREAKER_FAILURES'])
+        return response
+
+def classify_locally(text):
+    """Best guess at text's analysis without OpenAI: its nearest learned category, else its top terms."""
+    index = get_category_index()
+    if index is not None:
+        nearest = index.nearest(text, app.config['CATEGORY_MIN_DOCUMENTS'])
+        if nearest and nearest[0][0] >= app.config['CATEGORY_MERGE_THRESHOLD']:
+            category, subcategory = nearest[0][1]
+            return {'category': category, 'subcategory': subcategory, 'keywords': index.keywords((category, subcategory))}
+    labels, matrix, feature_names = cluster_texts([text], app.config['CLUSTER_DISTANCE_THRESHOLD'])
+    if matrix is None:
+        return dict(UNCATEGORIZED)
+    return name_cluster_by_terms(matrix.toarray()[0], feature_names)
+
+def is_valid_analysis(result):
+    """True if result has the string category and subcategory and keyword list the pipeline needs."""
+    return (isinstance(result, dict) and isinstance(result.get('category'), str)
+            and isinstance(result.get('subcategory'), str) and isinstance(result.get('keywords'), list))
+
 def analyze_document_content(text):
-    """Analyze document content using OpenAI API to extract topics and themes."""
+    """Analyze document content using OpenAI API to extract topics and themes.
+
+    Falls back to classify_locally when OpenAI fails or the circuit breaker is open.
+    """
+    text = prompt_excerpt(text)
+    cache = get_analysis_cache()
+    cache_key = AnalysisCache.make_key(text)
+    if cache is not None:
+        cached = cache.get(cache_key)
+        if cached is not None and not is_valid_analysis(cached):
+            cached = None  # written before results were validated
+        metrics.inc('organizer_llm_cache_total', result='miss' if cached is None else 'hit')
+        if cached is not None:
+            return cached
+
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": """You are a document analyzer. Analyze the content and suggest appropriate categorization. 
-                Rules:
-                1. Response must be valid JSON
-                2. Include:
-                   - 'category' (broad category like 'Education', 'Language', 'Mathematics', 'Personal')
-                   - 'subcategory' (general grouping like 'Assignments', 'Course_Materials', 'Exercises')
-                   - 'keywords' (list of 3-5 key terms found in content)
-                3. Use broad, inclusive categories to group related content together
-                4. Similar content should be grouped in the same subcategory
-                5. Avoid overly specific categorization"""},
-                {"role": "user", "content": f"Analyze this text and suggest a broad category for grouping similar documents: {text[:10000]}"}
-            ],
-            response_format={ "type": "json_object" }
-        )
+        response = create_chat_completion([
+            {"role": "system", "content": ANALYSIS_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Analyze this text and suggest a broad category for grouping similar documents: {text}"}
+        ])
         result = json.loads(response.choices[0].message.content)
+        if not is_valid_analysis(result):
+            raise ValueError(f'malformed analysis: {result}')
+        record_llm_usage(response, 'single')
         print(f"AI Analysis result: {result}")  # Debug logging
+        if cache is not None:
+            cache.put(cache_key, result)
         return result
     except Exception as e:
         print(f"Error analyzing document: {str(e)}")
-        return {
-            "category": "Uncategorized",
-            "subcategory": "Other",
-            "keywords": []
-        }
+        metrics.inc('organizer_llm_requests_total', kind='single', outcome='error')
+        metrics.inc('organizer_llm_fallbacks_total')
+        # Marked so a guess is never learned as a category or copied to near-duplicates
+        return dict(classify_locally(text), fallback=True)
+
+def plan_batches(texts, max_documents, token_budget):
+    """Greedily pack {key: excerpt} into batches bounded by document count and estimated tokens."""
+    batches = []
+    current, current_tokens = {}, 0
+    for key, text in texts.items():
+        tokens = estimate_tokens(text)
+        if current and (len(current) >= max_documents or current_tokens + tokens > token_budget):
+            batches.append(current)
+            current, current_tokens = {}, 0
+        current[key] = text
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def parse_batch_results(content, expected_ids):
+    """Map document ids to analyses from a batch response, dropping malformed entries."""
+    results = {}
+    try:
+        entries = json.loads(content).get('results', [])
+    except (ValueError, AttributeError):
+        return results
+    if not isinstance(entries, list):
+        return results
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        doc_id = str(entry.get('id'))
+        if (doc_id in expected_ids and isinstance(entry.get('category'), str)
+                and isinstance(entry.get('subcategory'), str)):
+            keywords = entry.get('keywords')
+            results[doc_id] = {
+                'category': entry['category'],
+                'subcategory': entry['subcategory'],
+                'keywords': keywords if isinstance(keywords, list) else []
+            }
+    return results
+
+def analyze_documents_batch(texts):
+    """Analyze several {key: text} documents in one request.
+
+    Returns analyses for the documents found in the cache or the response;
+    documents missing from a malformed or failed response are left for the
+    caller to analyze one at a time.
+    """
+    excerpt_chars = app.config['LLM_BATCH_EXCERPT_CHARS']
+    cache = get_analysis_cache()
+    results = {}
+    pending = {}
+    for key, text in texts.items():
+        excerpt = prompt_excerpt(text, excerpt_chars)
+        cache_key = AnalysisCache.make_key(excerpt, prompt_version=f"{ANALYSIS_PROMPT_VERSION}-batch")
+        cached = cache.get(cache_key) if cache is not None else None
+        if cache is not None:
+            metrics.inc('organizer_llm_cache_total', result='miss' if cached is None else 'hit')
+        if cached is not None:
+            results[key] = cached
+        else:
+            pending[key] = (excerpt, cache_key)
+
+    if len(pending) > 1:
+        ids = {str(index): key for index, key in enumerate(pending)}
+        prompt = "\n\n".join(f"### Document {doc_id}\n{pending[key][0]}" for doc_id, key in ids.items())
+        parsed = {}
+        try:
+            response = create_chat_completion([
+                {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+                {"role": "user", "content": f"Analyze each document and suggest a broad category for grouping similar documents:\n\n{prompt}"}
+            ])
+            record_llm_usage(response, 'batch')
+            parsed = parse_batch_results(response.choices[0].message.content, ids)
+            print(f"AI batch analysis: {len(parsed)}/{len(ids)} documents")  # Debug logging
+        except Exception as e:
+            print(f"Error analyzing document batch: {str(e)}")
+            metrics.inc('organizer_llm_requests_total', kind='batch', outcome='error')
+
+        for doc_id, key in ids.items():
+            if doc_id in parsed:
+                results[key] = parsed[doc_id]
+                if cache is not None:
+                    cache.put(pending[key][1], parsed[doc_id])
+    return results
+
+def analyze_texts(texts):
+    """Analyze {key: text} concurrently, packing several texts per request when LLM_BATCH_SIZE > 1."""
+    results = {}
+    max_workers = max(1, app.config['LLM_MAX_CONCURRENCY'])
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if app.config['LLM_BATCH_SIZE'] > 1:
+            excerpt_chars = app.config['LLM_BATCH_EXCERPT_CHARS']
+            batches = plan_batches(
+                {key: text[:excerpt_chars] for key, text in texts.items()},
+                app.config['LLM_BATCH_SIZE'],
+                app.config['LLM_BATCH_TOKEN_BUDGET'],
+            )
+            batch_futures = {executor.submit(analyze_documents_batch, {key: texts[key] for key in batch}): batch
+                             for batch in batches}
+            futures = {}
+            for future in as_completed(batch_futures):
+                results.update(future.result())
+                # Documents a batch missed go back on the same pool, so they still run concurrently
+                for key in batch_futures[future]:
+                    if key not in results:
+                        futures[executor.submit(analyze_document_content, texts[key])] = key
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        else:
+            futures = {executor.submit(analyze_document_content, text): key for key, text in texts.items()}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+    return results
+
+def normalize_analysis(analysis):
+    """Turn an analysis result into folder-safe category names."""
+    normalized = {
+        'category': analysis['category'].replace(' ', '_'),
+        'subcategory': analysis['subcategory'].replace(' ', '_'),
+        'keywords': analysis['keywords']
+    }
+    if analysis.get('fallback'):
+        normalized['fallback'] = True
+    return normalized
+
+def folder_key(name):
+    """Comparison key under which spelling variants of a folder name collide."""
+    key = re.sub(r'[^a-z0-9]', '', name.lower().replace('&', 'and'))
+    return key[:-1] if len(key) > 3 and key.endswith('s') else key
+
+def known_folders():
+    """Return {category: set of subcategories} from the category index and the organized tree."""
+    index = get_category_index()
+    folders = index.folders() if index is not None else defaultdict(set)
+    documents_root = os.path.join(app.config['ORGANIZED_FOLDER'], 'Documents')
+    if os.path.isdir(documents_root):
+        for category in os.listdir(documents_root):
+            category_path = os.path.join(documents_root, category)
+            if os.path.isdir(category_path):
+                folders[category].update(
+                    name for name in os.listdir(category_path) if os.path.isdir(os.path.join(category_path, name))
+                )
+    return folders
+
+def match_name(name, candidates):
+    """Return the existing name in candidates that name is a variant of, or None."""
+    keys = {folder_key(candidate): candidate for candidate in sorted(candidates)}
+    key = folder_key(name)
+    if key in keys:
+        return keys[key]
+    close = difflib.get_close_matches(key, list(keys), n=1, cutoff=0.85)
+    return keys[close[0]] if close else None
+
+def match_category(text):
+    """Place text in an existing folder when it is clearly nearest that folder's centroid, else None."""
+    index = get_category_index()
+    if index is None or not text.strip():
+        return None
+    nearest = index.nearest(text, app.config['CATEGORY_MIN_DOCUMENTS'])
+    if not nearest or nearest[0][0] < app.config['CATEGORY_MATCH_THRESHOLD']:
+        return None
+    if len(nearest) > 1 and nearest[0][0] - nearest[1][0] < app.config['CATEGORY_MATCH_MARGIN']:
+        return None
+    category, subcategory = nearest[0][1]
+    metrics.inc('organizer_category_matches_total')
+    keywords = index.keywords((category, subcategory))
+    lowered = text.lower()
+    return {
+        'category': category,
+        'subcategory': subcategory,
+        'keywords': [keyword for keyword in keywords if keyword.lower() in lowered] or keywords[:3]
+    }
+
+def find_near_duplicate(doc, text, batch_signatures=None):
+    """Find an already classified document that text nearly duplicates.
+
+    Returns (similarity, path, analysis) for a match in the near-duplicate index,
+    (similarity, earlier_doc, None) for a match among the docs in batch_signatures,
+    or None. doc's signature is added to batch_signatures when given.
+    """
+    index = get_near_duplicate_index()
+    if index is None:
+        return None
+    signature = minhash_signature(text)
+    if signature is None:
+        return None
+    threshold = app.config['NEAR_DUPLICATE_THRESHOLD']
+    best = None
+    for earlier, other in (batch_signatures or {}).items():
+        similarity = minhash_similarity(signature, other)
+        if similarity >= threshold and (best is None or similarity > best[0]):
+            best = (similarity, earlier, None)
+    matches = index.query(signature)
+    if matches and matches[0][0] >= threshold and (best is None or matches[0][0] > best[0]):
+        best = matches[0]
+    if batch_signatures is not None:
+        batch_signatures[doc] = signature
+    return best
+
+def inherit_analysis(analysis, similarity, source):
+    """Copy a near-duplicate's analysis, noting where it came from."""
+    metrics.inc('organizer_near_duplicates_total')
+    inherited = {key: analysis[key] for key in ('category', 'subcategory', 'keywords')}
+    inherited['near_duplicate'] = {'similar_to': source, 'similarity': round(similarity, 3)}
+    if analysis.get('fallback'):
+        inherited['fallback'] = True
+    return inherited
+
+def canonicalize_analysis(analysis, text=None, folders=None):
+    """Map analyzed names onto existing folders they vary, or whose centroid text is near.
+
+    folders is updated with the result so later documents in the batch reuse it.
+    """
+    if analysis['category'] == UNCATEGORIZED['category']:
+        return analysis
+    folders = known_folders() if folders is None else folders
+    category = match_name(analysis['category'], folders)
+    index = get_category_index()
+    if category is None and text and index is not None:
+        nearest = index.nearest(text, app.config['CATEGORY_MIN_DOCUMENTS'])
+        if nearest and nearest[0][0] >= app.config['CATEGORY_MERGE_THRESHOLD']:
+            category = nearest[0][1][0]
+    if category is None:
+        category = analysis['category']
+    subcategory = match_name(analysis['subcategory'], folders.get(category, ())) or analysis['subcategory']
+    if (category, subcategory) != (analysis['category'], analysis['subcategory']):
+        metrics.inc('organizer_category_renames_total')
+    folders.setdefault(category, set()).add(subcategory)
+    return dict(analysis, category=category, subcategory=subcategory)
+
+def classify_documents(documents, progress=None, timings=None, texts=None):
+    """Extract and classify documents using the configured ORGANIZER_MODE.
+
+    progress, if given, is called as progress(doc, 'classified') for each document;
+    per-file extraction seconds are added to timings['extract'] and the extracted
+    text of each document is stored in texts when given. Near-duplicates of an
+    already classified document inherit its analysis, documents close to an
+    existing category centroid are placed without analysis, and analyzed names are
+    canonicalized against the existing folders.
+    """
+    mode = app.config['ORGANIZER_MODE']
+    if mode in ('cluster', 'offline') or app.config['LLM_BATCH_SIZE'] > 1:
+        if mode in ('cluster', 'offline'):
+            document_analyses = classify_by_clusters(
+                documents, offline=(mode == 'offline'), timings=timings, texts=texts
+            )
+        else:
+            contents = dict(extract_documents(documents, timings))
+            if texts is not None:
+                texts.update(contents)
+            signatures = {}
+            near = {doc: find_near_duplicate(doc, contents[doc], signatures) for doc in documents}
+            matched = {doc: match_category(contents[doc]) for doc in documents if near[doc] is None}
+            analyses = analyze_texts({
+                doc: contents[doc] for doc in matched if matched[doc] is None and contents[doc].strip()
+            })
+            folders = known_folders()
+            document_analyses = {}
+            for doc in documents:
+                if near[doc] is not None:
+                    # Batch matches are always to an earlier document, which is already settled
+                    similarity, source, analysis = near[doc]
+                    if analysis is None:
+                        analysis, source = document_analyses[source], os.path.basename(source)
+                    document_analyses[doc] = inherit_analysis(analysis, similarity, source)
+                elif matched[doc] is not None:
+                    document_analyses[doc] = matched[doc]
+                elif doc in analyses:
+                    document_analyses[doc] = canonicalize_analysis(
+                        normalize_analysis(analyses[doc]), contents[doc], folders
+                    )
+                else:
+                    document_analyses[doc] = dict(UNCATEGORIZED)
+        if progress:
+            for doc in documents:
+                progress(doc, 'classified')
+        return document_analyses
+
+    document_analyses = {}
+    folders = known_folders()
+    signatures = {}
+    # Near-duplicates of documents still being analyzed wait for their result
+    followers = defaultdict(list)
+
+    def settle(doc, analysis):
+        document_analyses[doc] = analysis
+        if progress:
+            progress(doc, 'classified')
+        for follower, similarity in followers.pop(doc, []):
+            settle(follower, inherit_analysis(analysis, similarity, os.path.basename(doc)))
+
+    max_workers = max(1, app.config['LLM_MAX_CONCURRENCY'])
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for doc, content in extract_documents(documents, timings):
+            if texts is not None:
+                texts[doc] = content
+            near = find_near_duplicate(doc, content, signatures)
+            if near is not None:
+                similarity, source, analysis = near
+                if analysis is not None:
+                    settle(doc, inherit_analysis(analysis, similarity, source))
+                elif source in document_analyses:
+                    settle(doc, inherit_analysis(document_analyses[source], similarity, os.path.basename(source)))
+                else:
+                    followers[source].append((doc, similarity))
+                continue
+            matched = match_category(content)
+            if matched is None and content.strip():
+                futures[executor.submit(analyze_document_content, content)] = (doc, content)
+            else:
+                settle(doc, matched or dict(UNCATEGORIZED))
+
+        for future in as_completed(futures):
+            doc, content = futures[future]
+            settle(doc, canonicalize_analysis(normalize_analysis(future.result()), content, folders))
+
+    # Preserve upload order regardless of completion order
+    return {doc: document_analyses[doc] for doc in documents}
+
+def cluster_texts(texts, threshold):
+    """Group texts by TF-IDF cosine similarity using average-linkage hierarchical clustering.
+
+    Returns (labels, tfidf_matrix, feature_names); the matrix and names are None
+    when the texts share no usable vocabulary, in which case every text is its own cluster.
+    """
+    import numpy as np
+    from scipy.cluster.hierarchy import linkage, fcluster
+    from scipy.spatial.distance import squareform
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.metrics.pairwise import cosine_similarity
+
+    vectorizer = TfidfVectorizer(stop_words='english', sublinear_tf=True, max_features=20000)
+    try:
+        matrix = vectorizer.fit_transform(texts)
+    except ValueError:  # empty vocabulary
+        return list(range(1, len(texts) + 1)), None, None
+
+    if len(texts) == 1:
+        return [1], matrix, vectorizer.get_feature_names_out()
+
+    distances = np.clip(1 - cosine_similarity(matrix), 0, None)
+    np.fill_diagonal(distances, 0)
+    tree = linkage(squareform(distances, checks=False), method='average')
+    labels = fcluster(tree, t=threshold, criterion='distance')
+    return list(labels), matrix, vectorizer.get_feature_names_out()
+
+def name_cluster_by_terms(centroid, feature_names):
+    """Name a cluster offline from the highest weighted TF-IDF terms of its centroid."""
+    import numpy as np
+
+    top = [feature_names[i] for i in np.argsort(centroid)[::-1][:5] if centroid[i] > 0]
+    if not top:
+        return {'category': 'Uncategorized', 'subcategory': 'Other', 'keywords': []}
+    return {
+        'category': top[0].title(),
+        'subcategory': '_'.join(term.title() for term in top[1:3]) or 'General',
+        'keywords': top
+    }
+
+def classify_by_clusters(documents, offline=False, timings=None, texts=None):
+    """Classify documents one cluster at a time instead of one document at a time.
+
+    Each cluster is named by a single LLM call on its most central document, or
+    by its top TF-IDF terms when offline is set so no network access is needed.
+    Near-duplicates of indexed documents and documents close to an existing
+    category centroid skip clustering.
+    """
+    import numpy as np
+
+    contents = dict(extract_documents(documents, timings))
+    if texts is not None:
+        texts.update(contents)
+    document_analyses = {}
+    for doc, content in contents.items():
+        near = find_near_duplicate(doc, content)
+        if near is not None:
+            document_analyses[doc] = inherit_analysis(near[2], near[0], near[1])
+            continue
+        matched = match_category(content)
+        if matched is not None or not content.strip():
+            document_analyses[doc] = matched or dict(UNCATEGORIZED)
+    docs = [doc for doc in documents if doc not in document_analyses]
+    if not docs:
+        return document_analyses
+
+    labels, matrix, feature_names = cluster_texts(
+        [contents[doc] for doc in docs], app.config['CLUSTER_DISTANCE_THRESHOLD']
+    )
+    clusters = defaultdict(list)
+    for index, label in enumerate(labels):
+        clusters[label].append(index)
+
+    cluster_analyses = {}
+    representatives = {}
+    for label, members in clusters.items():
+        if matrix is None:
+            representative = members[0]
+            centroid = None
+        else:
+            centroid = np.asarray(matrix[members].mean(axis=0)).ravel()
+            representative = members[int(np.argmax(matrix[members] @ centroid))]
+        representatives[label] = contents[docs[representative]]
+
+        if offline:
+            if centroid is None:
+                cluster_analyses[label] = dict(UNCATEGORIZED)
+            else:
+                cluster_analyses[label] = name_cluster_by_terms(centroid, feature_names)
+
+    cluster_analyses.update(analyze_texts(
+        {label: text for label, text in representatives.items() if label not in cluster_analyses}
+    ))
+    folders = known_folders()
+    cluster_analyses = {
+        label: canonicalize_analysis(normalize_analysis(analysis), representatives[label], folders)
+        for label, analysis in cluster_analyses.items()
+    }
+
+    for index, label in enumerate(labels):
+        document_analyses[docs[index]] = cluster_analyses[label]
+    return {doc: document_analyses[doc] for doc in documents}
+
+def organize_files(uploaded_files, progress=None, hashes=None):
+    """Organize files based on type and content similarity.
 
-def organize_files(uploaded_files):
-    """Organize files based on type and content similarity."""
+    progress, if given, is called as progress(filepath, status) when a document
+    is classified and when any file reaches its final folder ('organized') or is
+    skipped as a copy of an already organized file ('duplicate'). hashes maps
+    upload paths to sha256 digests computed while saving; missing ones are computed here.
+    The returned stats include a 'timings' breakdown in seconds per stage.
+    """
+    started = time.perf_counter()
+    timings = {}
     org_base = app.config['ORGANIZED_FOLDER']
     os.makedirs(os.path.join(org_base, "Images"), exist_ok=True)
     os.makedirs(os.path.join(org_base, "Documents"), exist_ok=True)
     os.makedirs(os.path.join(org_base, "Other"), exist_ok=True)
 
+    catalog = get_catalog()
+    hashes = dict(hashes or {})
+
+    # Skip files whose content is already organized or repeated within this upload
+    duplicates = []
+    unique_files = []
+    seen = {}
+    dedup_started = time.perf_counter()
+    for filepath in uploaded_files:
+        digest = hashes.get(filepath) or file_digest(filepath)
+        hashes[filepath] = digest
+        existing = seen.get(digest)
+        if existing is None:
+            existing = next(
+                (path for path in catalog.find_by_hash(digest) if os.path.exists(os.path.join(org_base, path))),
+                None
+            )
+        if existing is None:
+            seen[digest] = os.path.basename(filepath)
+            unique_files.append(filepath)
+        else:
+            duplicates.append({'file': os.path.basename(filepath), 'existing': existing})
+            os.remove(filepath)
+            metrics.inc('organizer_files_total', type='duplicate')
+            if progress:
+                progress(filepath, 'duplicate')
+    timings['dedup'] = time.perf_counter() - dedup_started
+
     # Separate files by type
     images = []
     documents = []
     others = []
 
-    for filepath in uploaded_files:
+    for filepath in unique_files:
         ext = os.path.splitext(filepath)[1].lower()
         if ext in SUPPORTED_IMAGES:
             images.append(filepath)
@@ -114,30 +2207,37 @@ def organize_files(uploaded_files):
         else:
             others.append(filepath)
 
+    texts = {}
+
+    def place(filepath, folder, category, subcategory=None, keywords=()):
+        with timed(timings, 'move', 'organizer_stage_seconds', stage='move'):
+            size = os.path.getsize(filepath)
+            dest = os.path.relpath(move_file(filepath, folder, os.path.basename(filepath)), org_base)
+            snippet = make_snippet(texts[filepath]) if filepath in texts else None
+            catalog.add(dest, hashes[filepath], size, category, subcategory,
+                        keywords, snippet, texts.get(filepath))
+        if progress:
+            progress(filepath, 'organized')
+        return dest
+
     # Move images
     for img in images:
-        filename = os.path.basename(img)
-        shutil.move(img, os.path.join(org_base, "Images", filename))
+        place(img, os.path.join(org_base, "Images"), "Images")
 
     # Process and group documents
-    document_analyses = {}
-    for doc in documents:
-        content = extract_words_from_file(doc)
-        if content.strip():
-            analysis = analyze_document_content(content)
-            category = analysis['category'].replace(' ', '_')
-            subcategory = analysis['subcategory'].replace(' ', '_')
-            document_analyses[doc] = {
-                'category': category,
-                'subcategory': subcategory,
-                'keywords': analysis['keywords']
-            }
-        else:
-            document_analyses[doc] = {
-                'category': 'Uncategorized',
-                'subcategory': 'Other',
-                'keywords': []
-            }
+    classify_started = time.perf_counter()
+    document_analyses = classify_documents(documents, progress, timings, texts)
+    index = get_category_index()
+    if index is not None:
+        # Learn from this batch so later uploads can be placed without analysis
+        index.add([
+            (analysis['category'], analysis['subcategory'], texts[doc], analysis['keywords'])
+            for doc, analysis in document_analyses.items()
+            if analysis['category'] != UNCATEGORIZED['category'] and not analysis.get('fallback')
+            and texts.get(doc, '').strip()
+        ])
+    # Extraction overlaps classification, so 'classify' is the wall time of both
+    timings['classify'] = time.perf_counter() - classify_started
 
     # Group documents by category and subcategory
     organized_folders = defaultdict(lambda: defaultdict(list))
@@ -146,6 +2246,7 @@ def organize_files(uploaded_files):
 
     # Create folders and move documents
     folder_structure = {}
+    placed = {}
     for category, subcategories in organized_folders.items():
         folder_structure[category] = []
         for subcategory, docs in subcategories.items():
@@ -155,21 +2256,134 @@ def organize_files(uploaded_files):
                 folder_structure[category].append(subcategory)
                 
                 for doc in docs:
-                    filename = os.path.basename(doc)
-                    shutil.move(doc, os.path.join(folder_path, filename))
+                    placed[doc] = place(doc, folder_path, category, subcategory, document_analyses[doc]['keywords'])
+
+    near_duplicates = [
+        dict(analysis['near_duplicate'], file=os.path.basename(doc))
+        for doc, analysis in document_analyses.items() if 'near_duplicate' in analysis
+    ]
+    near_duplicate_index = get_near_duplicate_index()
+    if near_duplicate_index is not None:
+        entries = []
+        for doc, analysis in document_analyses.items():
+            signature = minhash_signature(texts.get(doc, ''))
+            if (signature is not None and analysis['category'] != UNCATEGORIZED['category']
+                    and not analysis.get('fallback')):
+                entries.append((placed[doc], signature,
+                                {key: analysis[key] for key in ('category', 'subcategory', 'keywords')}))
+        near_duplicate_index.add(entries)
 
     # Move other files
     for other in others:
-        filename = os.path.basename(other)
-        shutil.move(other, os.path.join(org_base, "Other", filename))
+        place(other, os.path.join(org_base, "Other"), "Other")
+
+    for kind, files in (('image', images), ('document', documents), ('other', others)):
+        if files:
+            metrics.inc('organizer_files_total', len(files), type=kind)
+    timings['total'] = time.perf_counter() - started
+    metrics.observe('organizer_batch_seconds', timings['total'])
 
     return {
         "images": len(images),
         "documents": len(documents),
         "others": len(others),
-        "folder_structure": folder_structure
+        "duplicates": duplicates,
+        "near_duplicates": near_duplicates,
+        "folder_structure": folder_structure,
+        "timings": {stage: round(seconds, 4) for stage, seconds in timings.items()}
     }
 
+def remove_job_folder(job_folder):
+    try:
+        os.rmdir(job_folder)
+    except OSError:
+        pass
+
+def discard_upload(uploaded_files, job_folder):
+    """Delete the files of an upload that will not be organized, along with its folder."""
+    for filepath in uploaded_files:
+        if os.path.exists(filepath):
+            try:
+                os.remove(filepath)
+            except:
+                pass
+    remove_job_folder(job_folder)
+
+def run_upload_job(job_id, uploaded_files, hashes=None, include_timings=False, expected=None):
+    """Organize one queued upload, recording per-file progress in the job store.
+
+    expected maps upload paths to the sha256 digests declared by the client; if
+    any file does not match, the job fails before anything is organized.
+    """
+    store = get_job_store()
+    store.update(job_id, status='running')
+    job_folder = os.path.join(app.config['UPLOAD_FOLDER'], job_id)
+    hashes = dict(hashes or {})
+    try:
+        mismatched = []
+        for filepath, digest in (expected or {}).items():
+            hashes[filepath] = file_digest(filepath, app.config['UPLOAD_CHUNK_SIZE'])
+            if hashes[filepath] != digest:
+                mismatched.append(os.path.basename(filepath))
+        if mismatched:
+            discard_upload(uploaded_files, job_folder)
+            store.update(job_id, status='failed',
+                         error=f"Checksum mismatch for {', '.join(mismatched)}; resend the upload")
+            return
+        stats = organize_files(
+            uploaded_files,
+            progress=lambda filepath, status: store.update_file(job_id, os.path.basename(filepath), status),
+            hashes=hashes
+        )
+        if not include_timings:
+            stats.pop('timings', None)
+    except Exception as e:
+        print(f"Error organizing files: {str(e)}")
+        # Clean up uploaded files in case of error
+        discard_upload(uploaded_files, job_folder)
+        store.update(job_id, status='failed', error=f'Error organizing files: {str(e)}')
+        return
+    # The folder goes before the final status, so a finished job has left nothing behind
+    remove_job_folder(job_folder)
+    store.update(job_id, status='completed', stats=stats)
+
+def missing_api_key_error():
+    """Return the error response when classifying needs an OpenAI API key and none is set, else None."""
+    if not os.getenv('OPENAI_API_KEY') and app.config['ORGANIZER_MODE'] != 'offline':
+        return jsonify({'error': 'OpenAI API key not configured'}), 500
+    return None
+
+def start_upload_job(job_id, uploaded_files, hashes, expected=None):
+    """Queue (or, with UPLOAD_ASYNC off, run) the job organizing saved uploads and build the response."""
+    # ?timings=1 adds a per-stage timing breakdown to the final stats
+    include_timings = request.args.get('timings') == '1'
+    store = get_job_store()
+    expire_jobs()
+    store.create(job_id, [os.path.basename(filepath) for filepath in uploaded_files], job_worker_id())
+    if app.config['UPLOAD_ASYNC']:
+        get_job_executor().submit(run_upload_job, job_id, uploaded_files, hashes, include_timings, expected)
+        return jsonify({
+            'message': 'Files queued for organization',
+            'job_id': job_id,
+            'status_url': url_for('job_status', job_id=job_id)
+        }), 202
+
+    run_upload_job(job_id, uploaded_files, hashes, include_timings, expected)
+    job = store.get(job_id)
+    if job['status'] == 'failed':
+        return jsonify({'error': job['error']}), 500
+    return jsonify({
+        'message': 'Files organized successfully',
+        'job_id': job_id,
+        'stats': job['stats']
+    })
+
+def expire_upload_sessions():
+    """Discard resumable uploads left unfinished for longer than UPLOAD_SESSION_TTL_HOURS."""
+    cutoff = time.time() - app.config['UPLOAD_SESSION_TTL_HOURS'] * 3600
+    for upload_id in get_upload_sessions().expire(cutoff):
+        shutil.rmtree(os.path.join(app.config['UPLOAD_FOLDER'], upload_id), ignore_errors=True)
+
 @app.route('/upload', methods=['POST'])
 def upload_files():
     try:
@@ -180,44 +2394,306 @@ def upload_files():
         if not files:
             return jsonify({'error': 'No files selected'}), 400
 
-        api_key = os.getenv('OPENAI_API_KEY')
-        if not api_key:
-            return jsonify({'error': 'OpenAI API key not configured'}), 500
+        error = missing_api_key_error()
+        if error:
+            return error
 
-        # Create necessary directories
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        # Each upload gets its own folder so concurrent jobs never share files
+        job_id = uuid.uuid4().hex
+        job_folder = os.path.join(app.config['UPLOAD_FOLDER'], job_id)
+        os.makedirs(job_folder, exist_ok=True)
         os.makedirs(app.config['ORGANIZED_FOLDER'], exist_ok=True)
         
         uploaded_files = []
+        hashes = {}
+        names = set()
         for file in files:
             if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
+                # Same name twice in one upload: keep both rather than overwrite
+                filename = unused_filename(secure_filename(file.filename), names)
+                names.add(filename)
+                filepath = os.path.join(job_folder, filename)
+                hashes[filepath] = save_upload(file, filepath, app.config['UPLOAD_CHUNK_SIZE'])
                 uploaded_files.append(filepath)
             else:
+                for filepath in uploaded_files:
+                    os.remove(filepath)
+                os.rmdir(job_folder)
                 return jsonify({'error': f'File type not allowed: {file.filename}'}), 400
 
-        try:
-            stats = organize_files(uploaded_files)
-            return jsonify({
-                'message': 'Files organized successfully',
-                'stats': stats
-            })
-        except Exception as e:
-            print(f"Error organizing files: {str(e)}")
-            # Clean up uploaded files in case of error
-            for filepath in uploaded_files:
-                if os.path.exists(filepath):
-                    try:
-                        os.remove(filepath)
-                    except:
-                        pass
-            return jsonify({'error': f'Error organizing files: {str(e)}'}), 500
+        return start_upload_job(job_id, uploaded_files, hashes)
+
+    except Exception as e:
+        print(f"Upload error: {str(e)}")
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Expose pipeline metrics in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report the status, per-file progress and final stats of an upload job"""
+    expire_jobs()
+    job = get_job_store().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Stream job updates as server-sent events until the job finishes"""
+    store = get_job_store()
+    if store.get(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    def generate():
+        last_update = None
+        # Streams are capped so a forgotten one never holds a server thread; EventSource reconnects
+        stream_end = time.monotonic() + app.config['JOB_EVENTS_MAX_SECONDS']
+        while time.monotonic() < stream_end:
+            expire_jobs()
+            job = store.get(job_id)
+            if job is None:
+                return
+            if job['updated'] != last_update:
+                last_update = job['updated']
+                yield f"data: {json.dumps(job)}\n\n"
+            if job['status'] in ('completed', 'failed'):
+                return
+            time.sleep(0.5)
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable upload by declaring its files; their chunks are sent with PUT"""
+    try:
+        data = request.get_json(silent=True) or {}
+        declared = data.get('files')
+        if not isinstance(declared, list) or not declared:
+            return jsonify({'error': 'No files declared'}), 400
+
+        chunk_size = data.get('chunk_size', app.config['UPLOAD_SESSION_CHUNK_SIZE'])
+        max_chunk = app.config['MAX_CONTENT_LENGTH']
+        if not isinstance(chunk_size, int) or isinstance(chunk_size, bool) or not 0 < chunk_size <= max_chunk:
+            return jsonify({'error': f'chunk_size must be between 1 and {max_chunk} bytes'}), 400
+
+        error = missing_api_key_error()
+        if error:
+            return error
+
+        for entry in declared:
+            if not isinstance(entry, dict) or not isinstance(entry.get('name'), str):
+                return jsonify({'error': 'Each file needs a name and size'}), 400
+            size = entry.get('size')
+            if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+                return jsonify({'error': f"Invalid size for {entry['name']}"}), 400
+            if not allowed_file(entry['name']):
+                return jsonify({'error': f"File type not allowed: {entry['name']}"}), 400
+        total = sum(entry['size'] for entry in declared)
+        if total > app.config['UPLOAD_SESSION_MAX_BYTES']:
+            return jsonify({'error': f"Upload exceeds {app.config['UPLOAD_SESSION_MAX_BYTES']} bytes"}), 413
+
+        expire_upload_sessions()
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        if shutil.disk_usage(app.config['UPLOAD_FOLDER']).free < total:
+            return jsonify({'error': 'Not enough disk space for this upload'}), 507
+
+        # The session id doubles as the job id, so its folder is the job folder
+        upload_id = uuid.uuid4().hex
+        upload_folder = os.path.join(app.config['UPLOAD_FOLDER'], upload_id)
+        os.makedirs(upload_folder)
+        files = []
+        for entry in declared:
+            filename = unused_filename(secure_filename(entry['name']), {f['name'] for f in files})
+            # Full-size (sparse) file up front: each chunk is written straight to its offset
+            with open(os.path.join(upload_folder, filename), 'wb') as f:
+                f.truncate(entry['size'])
+            digest = entry.get('sha256')
+            files.append({'name': filename, 'size': entry['size'], 'sha256': digest.lower() if digest else None})
+
+        store = get_upload_sessions()
+        store.create(upload_id, chunk_size, files)
+        session = store.get(upload_id)
+        session['status_url'] = url_for('upload_status', upload_id=upload_id)
+        return jsonify(session), 201
 
     except Exception as e:
         print(f"Upload error: {str(e)}")
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
+@app.route('/uploads/<upload_id>')
+def upload_status(upload_id):
+    """Report which chunks of a resumable upload are still missing"""
+    session = get_upload_sessions().get(upload_id)
+    if session is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    if session['status'] == 'completed':
+        session['job_url'] = url_for('job_status', job_id=upload_id)
+    return jsonify(session)
+
+@app.route('/uploads/<upload_id>/files/<int:index>/chunks/<int:chunk>', methods=['PUT'])
+def upload_chunk(upload_id, index, chunk):
+    """Write one chunk of a resumable upload at its offset, checked against X-Chunk-SHA256"""
+    store = get_upload_sessions()
+    session = store.get(upload_id)
+    if session is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    if session['status'] != 'open':
+        return jsonify({'error': 'Upload already completed'}), 409
+    if index >= len(session['files']) or chunk >= session['files'][index]['chunks']:
+        return jsonify({'error': 'Chunk out of range'}), 404
+
+    entry = session['files'][index]
+    offset = chunk * session['chunk_size']
+    length = min(session['chunk_size'], entry['size'] - offset)
+    if request.content_length != length:
+        return jsonify({'error': f'Chunk {chunk} of {entry["name"]} must be {length} bytes'}), 400
+    expected = request.headers.get('X-Chunk-SHA256', '').lower()
+    if not expected:
+        return jsonify({'error': 'X-Chunk-SHA256 header required'}), 400
+
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], upload_id, entry['name'])
+    try:
+        digest = write_chunk(filepath, offset, request.stream, length, app.config['UPLOAD_CHUNK_SIZE'])
+    except OSError as e:
+        print(f"Error writing chunk: {str(e)}")
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+    if digest is None:
+        return jsonify({'error': 'Chunk ended early'}), 400
+    if digest != expected:
+        # The bytes on disk are overwritten when the chunk is sent again
+        return jsonify({'error': f'Checksum mismatch for chunk {chunk} of {entry["name"]}'}), 400
+
+    store.add_chunk(upload_id, index, chunk, digest)
+    return jsonify({
+        'upload_id': upload_id,
+        'file': index,
+        'chunk': chunk,
+        'missing': len([missing for missing in entry['missing'] if missing != chunk])
+    })
+
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    """Check that every chunk of a resumable upload arrived and queue its files for organization"""
+    try:
+        store = get_upload_sessions()
+        session = store.get(upload_id)
+        if session is None:
+            return jsonify({'error': 'Upload not found'}), 404
+        if session['status'] != 'open':
+            return jsonify({'error': 'Upload already completed',
+                            'status_url': url_for('job_status', job_id=upload_id)}), 409
+        incomplete = {entry['name']: len(entry['missing']) for entry in session['files'] if entry['missing']}
+        if incomplete:
+            return jsonify({'error': 'Upload is missing chunks', 'missing': incomplete}), 409
+
+        error = missing_api_key_error()
+        if error:
+            return error
+
+        # Declared checksums are verified by the job, so completing never reads the files
+        uploaded_files = []
+        expected = {}
+        for entry in session['files']:
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], upload_id, entry['name'])
+            uploaded_files.append(filepath)
+            if entry['sha256']:
+                expected[filepath] = entry['sha256']
+
+        if not store.close(upload_id):
+            return jsonify({'error': 'Upload already completed',
+                            'status_url': url_for('job_status', job_id=upload_id)}), 409
+        os.makedirs(app.config['ORGANIZED_FOLDER'], exist_ok=True)
+        return start_upload_job(upload_id, uploaded_files, {}, expected)
+
+    except Exception as e:
+        print(f"Upload error: {str(e)}")
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+@app.route('/download/<path:filename>')
+def download_file(filename):
+    """Download an organized file by its path inside the organized folder.
+
+    Only files recorded in the catalog are served; send_from_directory handles
+    Range requests and lets the WSGI server use sendfile.
+    """
+    if get_catalog().get(filename) is None:
+        return jsonify({'error': 'File not found'}), 404
+    return send_from_directory(os.path.abspath(app.config['ORGANIZED_FOLDER']), filename, as_attachment=True)
+
+@app.route('/preview/<path:filename>')
+def preview_file(filename):
+    """Preview an organized file from its catalog entry without re-reading the file"""
+    entry = get_catalog().get(filename)
+    if entry is None:
+        return jsonify({'error': 'File not found'}), 404
+
+    preview = {
+        'path': entry['path'],
+        'size': entry['size'],
+        'category': entry['category'],
+        'subcategory': entry['subcategory'],
+        'keywords': entry['keywords'],
+        'snippet': entry['snippet'],
+        'download_url': url_for('download_file', filename=filename)
+    }
+    if os.path.splitext(filename)[1].lower() in SUPPORTED_IMAGES:
+        preview['thumbnail_url'] = url_for('thumbnail', filename=filename)
+    return jsonify(preview)
+
+@app.route('/export/<path:folder>')
+def export_folder(folder):
+    """Stream a ZIP of every catalogued file under a folder of the organized tree"""
+    folder = folder.strip('/')
+    entries = get_catalog().list_folder(folder)
+    if not entries:
+        return jsonify({'error': 'Folder not found'}), 404
+
+    org_base = app.config['ORGANIZED_FOLDER']
+    files = [(os.path.join(org_base, path), path[len(folder) + 1:]) for path, _ in entries]
+    name = secure_filename(folder.replace('/', '_')) or 'organized'
+    return Response(
+        stream_zip(files),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{name}.zip"'},
+        direct_passthrough=True
+    )
+
+@app.route('/search')
+def search():
+    """Full-text and keyword search over organized files, ranked by BM25"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Missing search query'}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+
+    started = time.perf_counter()
+    results = get_catalog().search(
+        query, request.args.get('category'), request.args.get('subcategory'), limit
+    )
+    for result in results:
+        result['download_url'] = url_for('download_file', filename=result['path'])
+    return jsonify({
+        'query': query,
+        'results': results,
+        'took_ms': round((time.perf_counter() - started) * 1000, 2)
+    })
+
+@app.route('/thumbnail/<path:filename>')
+def thumbnail(filename):
+    """Serve a cached JPEG thumbnail of an organized image"""
+    entry = get_catalog().get(filename)
+    if entry is None or os.path.splitext(filename)[1].lower() not in SUPPORTED_IMAGES:
+        return jsonify({'error': 'File not found'}), 404
+    path = cached_thumbnail(os.path.join(app.config['ORGANIZED_FOLDER'], filename), entry['hash'])
+    return send_from_directory(os.path.abspath(app.config['PREVIEW_CACHE_FOLDER']), os.path.basename(path),
+                               mimetype='image/jpeg')
+
 if __name__ == '__main__':
     app.run(debug=True) 
\ No newline at end of file
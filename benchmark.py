@@ -0,0 +1,511 @@
+"""Benchmark the file organizer pipeline against a local stand-in for the OpenAI API.
+
+Generates a synthetic corpus of PDF, DOCX, CSV and image files seeded from the
+text in samplefiles/, starts an OpenAI-compatible chat completions server with
+configurable latency and error rate, then measures each pipeline stage:
+
+    extract   extract_words_from_file per document
+    classify  analyze_document_content per document
+    organize  organize_files per batch
+    upload    POST /upload per batch (organized within the request)
+
+For every stage it reports throughput, p50/p95/p99 latency and peak Python heap
+memory (tracemalloc). Usage:
+
+    python benchmark.py --documents 200 --images 20 --latency-ms 400 --error-rate 0.02
+
+With --startup it instead measures cold start in fresh interpreters, with heavy
+dependencies imported lazily and with PRELOAD_DEPENDENCIES=1: time to import
+app, latency of the first GET / and first document extraction, and peak RSS.
+
+    python benchmark.py --startup --repeat 5
+"""
+import argparse
+import statistics
+import subprocess
+import io
+import json
+import math
+import os
+import random
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import tracemalloc
+import zlib
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+import app as organizer
+from docx import Document
+from openai import OpenAI
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samplefiles')
+
+# Sample file name prefix -> the category the mock assigns to text resembling it
+TOPIC_SAMPLES = [
+    ('Calculus', 'Mathematics', 'Exercises'),
+    ('English', 'Language', 'Assignments'),
+]
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    """Answers /v1/chat/completions with a keyword-based category after a simulated delay."""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        server = self.server
+        prompt = body['messages'][-1]['content']
+        prompt_tokens = len(prompt) // 4
+        time.sleep(max(0.0, random.gauss(server.latency, server.jitter)) + prompt_tokens / 1000 * server.latency_per_1k)
+
+        if random.random() < server.error_rate:
+            self._send(429, {'error': {'message': 'Rate limit reached', 'type': 'rate_limit_error'}})
+            return
+
+        documents = re.split(r'^### Document (\S+)\n', prompt, flags=re.M)
+        if len(documents) > 1:
+            results = [dict(mock_category(text), id=doc_id)
+                       for doc_id, text in zip(documents[1::2], documents[2::2])]
+            content = json.dumps({'results': results})
+        else:
+            content = json.dumps(mock_category(prompt))
+
+        with server.lock:
+            server.requests += 1
+            server.prompt_tokens += prompt_tokens
+        self._send(200, {
+            'id': 'chatcmpl-benchmark',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'gpt-3.5-turbo'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop'
+            }],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': 30,
+                      'total_tokens': prompt_tokens + 30}
+        })
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+_topic_models = None
+_topic_models_lock = threading.Lock()
+
+def topic_models():
+    """Per-topic smoothed word log-probabilities learned from the sample files."""
+    global _topic_models
+    with _topic_models_lock:
+        if _topic_models is None:
+            counts = {topic: defaultdict(int) for topic in TOPIC_SAMPLES}
+            for name in sorted(os.listdir(SAMPLE_DIR)):
+                for topic in TOPIC_SAMPLES:
+                    if name.startswith(topic[0]):
+                        text = organizer.extract_words_from_file(os.path.join(SAMPLE_DIR, name), max_chars=100000)
+                        for word in re.findall(r'[a-z]+', text.lower()):
+                            counts[topic][word] += 1
+            vocabulary = set().union(*counts.values())
+            _topic_models = {}
+            for topic, words in counts.items():
+                total = sum(words.values()) + len(vocabulary)
+                _topic_models[topic] = ({word: math.log((count + 1) / total) for word, count in words.items()},
+                                        math.log(1 / total))
+        return _topic_models
+
+def mock_category(text):
+    """Naive Bayes stand-in for the model: the sample topic that text most resembles."""
+    models = topic_models()
+    words = [word for word in re.findall(r'[a-z]+', text.lower())
+             if any(word in model[0] for model in models.values())]
+    if not words:
+        return {'category': 'General', 'subcategory': 'Documents', 'keywords': []}
+    (_, category, subcategory), (model, _) = max(
+        models.items(), key=lambda item: sum(item[1][0].get(word, item[1][1]) for word in words)
+    )
+    keywords = sorted(set(words), key=lambda word: -model.get(word, 0))[:3]
+    return {'category': category, 'subcategory': subcategory, 'keywords': keywords}
+
+def start_mock_server(latency=0.3, jitter=0.05, error_rate=0.0, latency_per_1k=0.0):
+    """Start the mock OpenAI server on a free local port; returns the server.
+
+    Each request takes latency (+/- jitter) seconds plus latency_per_1k per
+    thousand prompt tokens.
+    """
+    topic_models()  # build once up front so the first request is not slowed down
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockOpenAIHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    server.latency_per_1k = latency_per_1k
+    server.requests = 0
+    server.prompt_tokens = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def seed_vocabulary():
+    """Return word lists extracted from each sample document."""
+    vocabularies = []
+    for name in sorted(os.listdir(SAMPLE_DIR)):
+        words = organizer.extract_words_from_file(os.path.join(SAMPLE_DIR, name), max_chars=100000).split()
+        if len(words) > 50:
+            vocabularies.append(words)
+    return vocabularies
+
+def write_pdf(path, text, line_chars=90, lines_per_page=50):
+    """Write a minimal text-only PDF that PyPDF2 can extract."""
+    lines = textwrap.wrap(text, line_chars) or ['']
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)]
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for page_lines in pages:
+        escaped = [line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') for line in page_lines]
+        stream = 'BT /F1 10 Tf 12 TL 40 800 Td ' + ' '.join(f'({line}) Tj T*' for line in escaped) + ' ET'
+        stream = stream.encode('latin-1', 'replace')
+        objects.append(b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream')
+        content_id = len(objects)
+        objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] '
+                       b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % content_id)
+        kids.append(len(objects))
+    objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+        b' '.join(b'%d 0 R' % kid for kid in kids), len(kids))
+
+    out = io.BytesIO()
+    out.write(b'%PDF-1.4\n')
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b'%d 0 obj\n' % number + obj + b'\nendobj\n')
+    xref = out.tell()
+    out.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b'%010d 00000 n \n' % offset)
+    out.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref))
+    with open(path, 'wb') as f:
+        f.write(out.getvalue())
+
+def write_docx(path, text, paragraph_words=80):
+    document = Document()
+    words = text.split()
+    for i in range(0, len(words), paragraph_words):
+        document.add_paragraph(' '.join(words[i:i + paragraph_words]))
+    document.save(path)
+
+def write_csv(path, text, row_words=8):
+    words = text.split()
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(0, len(words), row_words):
+            f.write(','.join(words[i:i + row_words]) + '\n')
+
+def write_png(path, rng, size=64):
+    """Write a small random-noise PNG."""
+    raw = b''.join(b'\x00' + bytes(rng.getrandbits(8) for _ in range(size * 3)) for _ in range(size))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw)))
+        f.write(chunk(b'IEND', b''))
+
+WRITERS = {'pdf': write_pdf, 'docx': write_docx, 'csv': write_csv}
+
+# Cover page and license text that says nothing about a document's topic
+BOILERPLATE = [
+    'This material is made available under a Creative Commons Attribution Noncommercial Share Alike license.',
+    'For information about citing these materials or our Terms of Use, visit the website listed on the cover.',
+    'All rights in third party content are reserved by their respective owners.',
+    'Please do not redistribute this document without written permission from the publisher.',
+    'Printed copies are uncontrolled and may not reflect the latest revision of this document.',
+    'Page headers, footers and the table of contents were generated automatically.',
+]
+
+def boilerplate(words, rng):
+    """Return about words words of topic-free front matter."""
+    sentences = []
+    count = 0
+    while count < words:
+        sentence = f"Revision {rng.randrange(1, 99)}. " + rng.choice(BOILERPLATE)
+        sentences.append(sentence)
+        count += len(sentence.split())
+    return ' '.join(sentences)
+
+def generate_corpus(folder, documents=50, images=5, words=1500, kinds=('pdf', 'docx', 'csv'), seed=0,
+                    boilerplate_words=0):
+    """Create a synthetic corpus in folder; returns the list of file paths.
+
+    boilerplate_words of cover page and license text are put before each document's content.
+    """
+    rng = random.Random(seed)
+    vocabularies = seed_vocabulary()
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i in range(documents):
+        vocabulary = vocabularies[i % len(vocabularies)]
+        start = rng.randrange(max(1, len(vocabulary) - words))
+        text = ' '.join(vocabulary[start:start + words])
+        # A unique marker keeps every document's content distinct for the duplicate check
+        text = f'document {seed}-{i} ' + text
+        if boilerplate_words:
+            text = boilerplate(boilerplate_words, rng) + ' ' + text
+        kind = kinds[i % len(kinds)]
+        path = os.path.join(folder, f'doc{i:05d}.{kind}')
+        WRITERS[kind](path, text)
+        paths.append(path)
+    for i in range(images):
+        path = os.path.join(folder, f'img{i:05d}.png')
+        write_png(path, rng)
+        paths.append(path)
+    return paths
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+def measure(name, items, run, units_per_item=lambda item: 1):
+    """Time run(item) for each item, tracking latency, throughput and peak heap memory."""
+    latencies = []
+    units = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    for item in items:
+        began = time.perf_counter()
+        run(item)
+        latencies.append(time.perf_counter() - began)
+        units += units_per_item(item)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'stage': name,
+        'count': len(latencies),
+        'units': units,
+        'seconds': elapsed,
+        'throughput': units / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_mb': peak / (1024 * 1024)
+    }
+
+STARTUP_PROBE = textwrap.dedent('''
+    import json, os, resource, sys, time
+    began = time.perf_counter()
+    import app
+    imported = time.perf_counter()
+    app.app.test_client().get('/')
+    first_request = time.perf_counter()
+    app.extract_words_from_file(sys.argv[1])
+    first_extract = time.perf_counter()
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({
+        'import_ms': (imported - began) * 1000,
+        'first_request_ms': (first_request - imported) * 1000,
+        'first_extract_ms': (first_extract - first_request) * 1000,
+        'rss_mb': rss_kb / (1024 if sys.platform != 'darwin' else 1024 * 1024),
+    }))
+''')
+
+def run_startup_benchmark(args):
+    """Median cold-start timings over fresh interpreters, lazy versus preloaded."""
+    sample = os.path.join(SAMPLE_DIR, sorted(name for name in os.listdir(SAMPLE_DIR) if name.endswith('.pdf'))[0])
+    results = []
+    for mode, preload in (('lazy', '0'), ('preload', '1')):
+        env = dict(os.environ, PRELOAD_DEPENDENCIES=preload)
+        env.pop('OPENAI_API_KEY', None)
+        runs = []
+        for _ in range(args.repeat):
+            output = subprocess.run([sys.executable, '-c', STARTUP_PROBE, sample], env=env,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        summary = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        results.append(dict(summary, mode=mode, runs=len(runs)))
+    return results
+
+def format_startup_results(results):
+    header = f"{'mode':<10}{'runs':>6}{'import ms':>12}{'GET / ms':>12}{'extract ms':>12}{'RSS MB':>10}"
+    lines = [header, '-' * len(header)]
+    for r in results:
+        lines.append(f"{r['mode']:<10}{r['runs']:>6}{r['import_ms']:>12.1f}{r['first_request_ms']:>12.1f}"
+                     f"{r['first_extract_ms']:>12.1f}{r['rss_mb']:>10.1f}")
+    return '\n'.join(lines)
+
+def copy_batch(paths, folder):
+    os.makedirs(folder, exist_ok=True)
+    copies = []
+    for path in paths:
+        dest = os.path.join(folder, os.path.basename(path))
+        shutil.copyfile(path, dest)
+        copies.append(dest)
+    return copies
+
+def run_benchmark(args):
+    """Run every stage and return the list of per-stage results."""
+    workdir = args.workdir or tempfile.mkdtemp(prefix='organizer-bench-')
+    server = start_mock_server(args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate,
+                               args.latency_per_1k_tokens_ms / 1000)
+    original_client = organizer.client
+    original_config = dict(organizer.app.config)
+    organizer.client = OpenAI(
+        api_key='benchmark', base_url=f'http://127.0.0.1:{server.server_address[1]}/v1', max_retries=0
+    )
+    organizer.app.config.update({
+        'ORGANIZER_MODE': args.mode,
+        'LLM_MAX_CONCURRENCY': args.concurrency,
+        'LLM_BATCH_SIZE': args.llm_batch_size,
+        'PROMPT_TOKEN_BUDGET': args.prompt_token_budget,
+        'LLM_HEDGE_PERCENTILE': args.hedge_percentile,
+        'EXTRACT_WORKERS': args.extract_workers,
+        'ANALYSIS_CACHE_PATH': '',
+        'UPLOAD_ASYNC': False,
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'ORGANIZED_FOLDER': os.path.join(workdir, 'organized'),
+        'JOB_STORE_PATH': os.path.join(workdir, 'jobs.sqlite3'),
+        'CATEGORY_INDEX_PATH': os.path.join(workdir, 'categories.sqlite3') if args.category_index else '',
+        'NEAR_DUPLICATE_INDEX_PATH': os.path.join(workdir, 'near_duplicates.sqlite3') if args.near_duplicates else '',
+        'MAX_CONTENT_LENGTH': None,
+    })
+
+    try:
+        corpus = generate_corpus(os.path.join(workdir, 'corpus'), args.documents, args.images,
+                                 args.words, tuple(args.kinds.split(',')), args.seed, args.boilerplate_words)
+        documents = [path for path in corpus if not path.endswith('.png')]
+        batches = [corpus[i:i + args.batch_size] for i in range(0, len(corpus), args.batch_size)]
+        texts = {}
+        results = []
+
+        def extract(path):
+            texts[path] = organizer.extract_words_from_file(path)
+
+        results.append(measure('extract', documents, extract))
+        if args.mode != 'offline':
+            categories = {}
+
+            def classify(path):
+                categories[path] = organizer.analyze_document_content(texts[path])['category']
+
+            requests_before, tokens_before = server.requests, server.prompt_tokens
+            result = measure('classify', documents, classify)
+            # Quality: how often the prompt excerpt gets the label the whole document would
+            result['agreement'] = sum(
+                categories[path] == mock_category(texts[path])['category'] for path in documents
+            ) / max(1, len(documents))
+            result['prompt_tokens'] = (server.prompt_tokens - tokens_before) / max(1, server.requests - requests_before)
+            results.append(result)
+
+        def organize(batch):
+            # Fresh catalog per batch so files from earlier stages are not treated as duplicates
+            organizer.app.config['CATALOG_PATH'] = os.path.join(workdir, f'catalog-{time.perf_counter_ns()}.sqlite3')
+            organizer.organize_files(copy_batch(batch, os.path.join(workdir, 'staging')))
+
+        results.append(measure('organize', batches, organize, len))
+
+        client = organizer.app.test_client()
+
+        def upload(batch):
+            organizer.app.config['CATALOG_PATH'] = os.path.join(workdir, f'catalog-{time.perf_counter_ns()}.sqlite3')
+            files = []
+            for path in batch:
+                with open(path, 'rb') as f:
+                    files.append((io.BytesIO(f.read()), os.path.basename(path)))
+            response = client.post('/upload', data={'files[]': files})
+            if response.status_code != 200:
+                raise RuntimeError(f'/upload failed: {response.get_json()}')
+
+        results.append(measure('upload', batches, upload, len))
+        for result in results:
+            result['llm_requests'] = server.requests
+        return results
+    finally:
+        server.shutdown()
+        organizer.client = original_client
+        organizer.app.config.clear()
+        organizer.app.config.update(original_config)
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def format_results(results):
+    header = f"{'stage':<10}{'count':>7}{'seconds':>10}{'items/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak MB':>10}"
+    lines = [header, '-' * len(header)]
+    for r in results:
+        lines.append(f"{r['stage']:<10}{r['count']:>7}{r['seconds']:>10.2f}{r['throughput']:>10.1f}"
+                     f"{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}{r['peak_mb']:>10.1f}")
+    return '\n'.join(lines)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--documents', type=int, default=50, help='synthetic documents to generate')
+    parser.add_argument('--images', type=int, default=5, help='synthetic images to generate')
+    parser.add_argument('--words', type=int, default=1500, help='words per document')
+    parser.add_argument('--boilerplate-words', type=int, default=0,
+                        help='topic-free front matter before each document, as on title pages')
+    parser.add_argument('--kinds', default='pdf,docx,csv', help='comma separated document formats')
+    parser.add_argument('--batch-size', type=int, default=20, help='files per organize/upload batch')
+    parser.add_argument('--latency-ms', type=float, default=300, help='mean mock OpenAI latency')
+    parser.add_argument('--jitter-ms', type=float, default=50, help='standard deviation of latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered 429')
+    parser.add_argument('--latency-per-1k-tokens-ms', type=float, default=0,
+                        help='extra mock latency per thousand prompt tokens')
+    parser.add_argument('--prompt-token-budget', type=int, default=600,
+                        help='PROMPT_TOKEN_BUDGET (0 sends the first 10000 characters)')
+    parser.add_argument('--mode', default='llm', choices=['llm', 'cluster', 'offline'], help='ORGANIZER_MODE')
+    parser.add_argument('--hedge-percentile', type=float, default=0, help='LLM_HEDGE_PERCENTILE')
+    parser.add_argument('--concurrency', type=int, default=8, help='LLM_MAX_CONCURRENCY')
+    parser.add_argument('--llm-batch-size', type=int, default=1, help='LLM_BATCH_SIZE')
+    parser.add_argument('--category-index', action='store_true',
+                        help='place documents near learned category centroids without analysis')
+    parser.add_argument('--near-duplicates', action='store_true',
+                        help='let near-duplicate documents inherit an earlier analysis')
+    parser.add_argument('--extract-workers', type=int, default=os.cpu_count() or 1, help='EXTRACT_WORKERS')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='keep corpus and output here instead of a temp dir')
+    parser.add_argument('--keep', action='store_true', help='do not delete the temp dir')
+    parser.add_argument('--json', help='also write results to this JSON file')
+    parser.add_argument('--startup', action='store_true', help='measure cold start instead of the pipeline')
+    parser.add_argument('--repeat', type=int, default=3, help='fresh interpreters per --startup mode')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.startup:
+        results = run_startup_benchmark(args)
+        print(format_startup_results(results))
+    else:
+        results = run_benchmark(args)
+        print(format_results(results))
+        print(f"mock OpenAI requests: {results[-1]['llm_requests'] if results else 0}")
+        for result in results:
+            if 'agreement' in result:
+                print(f"classify: {result['prompt_tokens']:.0f} prompt tokens per request, "
+                      f"{result['agreement']:.1%} agree with full-text labels")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,7 @@
 const API_URL = 'http://localhost:5000';  // Local development backend URL
 
 document.addEventListener('DOMContentLoaded', function() {
+    const MAX_FORM_BYTES = 16 * 1024 * 1024;  // /upload limit
     const dropZone = document.getElementById('dropZone');
     const fileInput = document.getElementById('fileInput');
     const selectButton = document.getElementById('selectButton');
@@ -57,39 +58,116 @@ document.addEventListener('DOMContentLoaded', function() {
         message.className = 'info';
         message.textContent = 'Uploading and organizing files...';
 
-        fetch(`${API_URL}/upload`, {
-            method: 'POST',
-            body: formData
-        })
-        .then(response => {
-            if (!response.ok) {
-                throw new Error(`HTTP error! status: ${response.status}`);
-            }
-            return response.json();
-        })
+        // Batches over the /upload size limit go through the resumable chunked protocol
+        const totalSize = Array.from(files).reduce((sum, file) => sum + file.size, 0);
+        const upload = totalSize < MAX_FORM_BYTES
+            ? fetch(`${API_URL}/upload`, { method: 'POST', body: formData }).then(readJson)
+            : uploadInChunks(Array.from(files));
+
+        upload
         .then(data => {
             if (data.error) {
                 throw new Error(data.error);
             }
-            message.className = 'success';
-            let statsMessage = `${data.message}\n`;
-            statsMessage += `Images: ${data.stats.images}, Documents: ${data.stats.documents}, Others: ${data.stats.others}\n\n`;
-            
-            if (data.stats.folder_structure) {
-                statsMessage += 'Organized Structure:\n';
-                Object.entries(data.stats.folder_structure).forEach(([category, subcategories]) => {
-                    statsMessage += `${category}/\n`;
-                    subcategories.forEach(sub => {
-                        statsMessage += `  └── ${sub}/\n`;
-                    });
-                });
+            if (data.status_url) {
+                return pollJob(data.status_url);
             }
-            
-            message.textContent = statsMessage;
+            return data;
+        })
+        .then(data => {
+            message.className = 'success';
+            showStats(data.message, data.stats);
         })
         .catch(error => {
             message.className = 'error';
             message.textContent = `Error: ${error.message}`;
         });
     }
+
+    function readJson(response) {
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        return response.json();
+    }
+
+    function uploadInChunks(files) {
+        return fetch(`${API_URL}/uploads`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ files: files.map(file => ({ name: file.name, size: file.size })) })
+        })
+        .then(readJson)
+        .then(session => sendChunks(session, files))
+        .then(session => fetch(`${API_URL}/uploads/${session.upload_id}/complete`, { method: 'POST' }))
+        .then(readJson);
+    }
+
+    async function sendChunks(session, files) {
+        const total = session.files.reduce((sum, entry) => sum + entry.missing.length, 0);
+        let sent = 0;
+        for (const [index, entry] of session.files.entries()) {
+            for (const chunk of entry.missing) {
+                const start = chunk * session.chunk_size;
+                const body = await files[index].slice(start, start + session.chunk_size).arrayBuffer();
+                const digest = new Uint8Array(await crypto.subtle.digest('SHA-256', body));
+                const checksum = Array.from(digest, byte => byte.toString(16).padStart(2, '0')).join('');
+                await putChunk(`${API_URL}/uploads/${session.upload_id}/files/${index}/chunks/${chunk}`, body, checksum, 3);
+                sent += 1;
+                message.textContent = `Uploading files... ${Math.round(100 * sent / total)}%`;
+            }
+        }
+        return session;
+    }
+
+    function putChunk(url, body, checksum, retries) {
+        return fetch(url, { method: 'PUT', headers: { 'X-Chunk-SHA256': checksum }, body })
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`HTTP error! status: ${response.status}`);
+                }
+            })
+            .catch(error => {
+                if (retries === 0) {
+                    throw error;
+                }
+                // A dropped connection only costs this chunk: wait and send it again
+                return new Promise(resolve => setTimeout(resolve, 1000))
+                    .then(() => putChunk(url, body, checksum, retries - 1));
+            });
+    }
+
+    function pollJob(statusUrl) {
+        return fetch(`${API_URL}${statusUrl}`)
+            .then(response => response.json())
+            .then(job => {
+                if (job.error) {
+                    throw new Error(job.error);
+                }
+                if (job.status === 'completed') {
+                    return { message: 'Files organized successfully', stats: job.stats };
+                }
+                message.className = 'info';
+                message.textContent = `Organizing files... ${job.progress.done}/${job.progress.total}`;
+                return new Promise(resolve => setTimeout(resolve, 1000))
+                    .then(() => pollJob(statusUrl));
+            });
+    }
+
+    function showStats(title, stats) {
+        let statsMessage = `${title}\n`;
+        statsMessage += `Images: ${stats.images}, Documents: ${stats.documents}, Others: ${stats.others}\n\n`;
+        
+        if (stats.folder_structure) {
+            statsMessage += 'Organized Structure:\n';
+            Object.entries(stats.folder_structure).forEach(([category, subcategories]) => {
+                statsMessage += `${category}/\n`;
+                subcategories.forEach(sub => {
+                    statsMessage += `  └── ${sub}/\n`;
+                });
+            });
+        }
+        
+        message.textContent = statsMessage;
+    }
 }); 
\ No newline at end of file
@@ -0,0 +1,240 @@
+"""Organize an existing directory tree in bulk, without the /upload size limit.
+
+Walks SOURCE for supported files and runs them through organize_files in
+batches, copying (or, with --move, moving) the next batch into a staging folder
+while the current one is extracted, classified and moved. Every file that reaches
+the organized tree, or is skipped as a duplicate, is appended to a checkpoint
+file, so rerunning an interrupted ingest resumes without reprocessing finished
+files. Usage:
+
+    python ingest.py ~/Archive --batch-size 200 --mode cluster
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.utils import secure_filename
+
+import app as organizer
+
+class Checkpoint:
+    """Append-only JSON lines record of source files that are already organized."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # torn last line from an interrupted run
+                        continue
+                    self.done.add((entry['path'], entry['size'], entry['mtime']))
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def record(self, key, status):
+        path, size, mtime = key
+        with self._lock:
+            self._file.write(json.dumps({'path': path, 'size': size, 'mtime': mtime, 'status': status}) + '\n')
+            self._file.flush()
+            self.done.add(key)
+
+    def sync(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+def file_key(path):
+    """Identify a source file by absolute path, size and modification time."""
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+def iter_source_files(source):
+    """Yield every supported file under source in a stable order."""
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        for name in sorted(files):
+            if organizer.allowed_file(name):
+                yield os.path.join(root, name)
+
+def copy_file(src, folder, filename, chunk_size=1024 * 1024):
+    """Copy src into folder under an unused name, returning (path, sha256 hex digest)."""
+    base, ext = os.path.splitext(filename)
+    for attempt in itertools.count():
+        dest = os.path.join(folder, filename if attempt == 0 else f"{base}_{attempt}{ext}")
+        try:
+            out = open(dest, 'xb')
+        except FileExistsError:
+            continue
+        digest = hashlib.sha256()
+        with out, open(src, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+                out.write(chunk)
+        return dest, digest.hexdigest()
+
+def stage_batch(batch, folder, move=False):
+    """Bring a batch of (source, key) pairs into folder.
+
+    Returns ({staged path: (source, key)}, {staged path: sha256}, failed count).
+    """
+    os.makedirs(folder, exist_ok=True)
+    staged = {}
+    hashes = {}
+    failed = 0
+    for source, key in batch:
+        filename = secure_filename(os.path.basename(source)) or 'file' + os.path.splitext(source)[1].lower()
+        try:
+            if move:
+                path = organizer.move_file(source, folder, filename)
+                hashes[path] = organizer.file_digest(path)
+            else:
+                path, hashes[path] = copy_file(source, folder, filename)
+        except OSError as e:
+            print(f"Error staging {source}: {str(e)}")
+            failed += 1
+            continue
+        staged[path] = (source, key)
+    return staged, hashes, failed
+
+def release_staged(staged, move=False):
+    """Put back staged files that were not organized: moved files return to their source."""
+    for path, (source, _) in staged.items():
+        if not os.path.exists(path):
+            continue
+        try:
+            if move:
+                shutil.move(path, source)
+            else:
+                os.remove(path)
+        except OSError as e:
+            print(f"Error releasing {path}: {str(e)}")
+
+def format_progress(done, total, size, elapsed):
+    rate = done / elapsed if elapsed else 0.0
+    eta = (total - done) / rate if rate else 0.0
+    return (f"[{done}/{total}] {rate:.1f} files/s, {size / (1024 * 1024) / elapsed if elapsed else 0.0:.1f} MB/s, "
+            f"eta {eta:.0f}s")
+
+def run_ingest(args):
+    """Organize every unfinished file under args.source and return the run totals."""
+    config = organizer.app.config
+    if args.organized:
+        config['ORGANIZED_FOLDER'] = args.organized
+    if args.mode:
+        config['ORGANIZER_MODE'] = args.mode
+    if args.extract_workers:
+        config['EXTRACT_WORKERS'] = args.extract_workers
+    if args.concurrency:
+        config['LLM_MAX_CONCURRENCY'] = args.concurrency
+
+    checkpoint = Checkpoint(args.checkpoint)
+    pending = []
+    skipped = 0
+    for path in iter_source_files(args.source):
+        key = file_key(path)
+        if key in checkpoint.done:
+            skipped += 1
+        else:
+            pending.append((path, key))
+    batches = [pending[i:i + args.batch_size] for i in range(0, len(pending), args.batch_size)]
+    print(f"{len(pending)} files to organize, {skipped} already done")
+
+    totals = {'organized': 0, 'duplicate': 0, 'failed': 0, 'skipped': skipped}
+    staging_root = os.path.join(config['UPLOAD_FOLDER'], f"ingest-{uuid.uuid4().hex}")
+    started = time.perf_counter()
+    done = 0
+    size = 0
+    staged = {}
+
+    def progress(filepath, status):
+        if status in ('organized', 'duplicate'):
+            checkpoint.record(staged[filepath][1], status)
+            totals[status] += 1
+
+    # Stage the next batch on a second thread while the current one is organized
+    stager = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingest-stage')
+    try:
+        next_batch = stager.submit(stage_batch, batches[0], os.path.join(staging_root, '0'), args.move) \
+            if batches else None
+        for number, batch in enumerate(batches):
+            staged, hashes, failed = next_batch.result()
+            totals['failed'] += failed
+            if number + 1 < len(batches):
+                next_batch = stager.submit(
+                    stage_batch, batches[number + 1], os.path.join(staging_root, str(number + 1)), args.move
+                )
+            try:
+                organizer.organize_files(list(staged), progress=progress, hashes=hashes)
+            except Exception as e:
+                print(f"Error organizing batch {number + 1}: {str(e)}")
+                totals['failed'] += sum(1 for path in staged if os.path.exists(path))
+            finally:
+                release_staged(staged, args.move)
+                checkpoint.sync()
+                shutil.rmtree(os.path.join(staging_root, str(number)), ignore_errors=True)
+            done += len(batch)
+            size += sum(key[1] for _, key in batch)
+            print(format_progress(done, len(pending), size, time.perf_counter() - started), flush=True)
+    finally:
+        stager.shutdown(wait=True)
+        if next_batch is not None and next_batch.done() and not next_batch.exception():
+            release_staged(next_batch.result()[0], args.move)
+        release_staged(staged, args.move)
+        shutil.rmtree(staging_root, ignore_errors=True)
+        checkpoint.close()
+
+    totals['seconds'] = round(time.perf_counter() - started, 2)
+    return totals
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('source', help='directory to organize')
+    parser.add_argument('--organized', help='ORGANIZED_FOLDER to file documents into')
+    parser.add_argument('--checkpoint', default='ingest_checkpoint.jsonl',
+                        help='progress file; rerun with the same file to resume, delete it to start over')
+    parser.add_argument('--batch-size', type=int, default=100, help='files per organize_files call')
+    parser.add_argument('--move', action='store_true', help='move files out of source instead of copying them')
+    parser.add_argument('--mode', choices=['llm', 'cluster', 'offline'], help='ORGANIZER_MODE')
+    parser.add_argument('--extract-workers', type=int, help='EXTRACT_WORKERS')
+    parser.add_argument('--concurrency', type=int, help='LLM_MAX_CONCURRENCY')
+    args = parser.parse_args(argv)
+    if args.batch_size < 1:
+        parser.error('--batch-size must be at least 1')
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.isdir(args.source):
+        print(f"Error: {args.source} is not a directory")
+        return 2
+    mode = args.mode or organizer.app.config['ORGANIZER_MODE']
+    if mode != 'offline' and not os.getenv('OPENAI_API_KEY'):
+        print("Error: OpenAI API key not configured (use --mode offline to organize without it)")
+        return 2
+    try:
+        totals = run_ingest(args)
+    except KeyboardInterrupt:
+        print(f"Interrupted; rerun with --checkpoint {args.checkpoint} to resume")
+        return 130
+    print(f"organized {totals['organized']}, duplicates {totals['duplicate']}, failed {totals['failed']}, "
+          f"previously done {totals['skipped']} in {totals['seconds']}s")
+    return 1 if totals['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
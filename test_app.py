@@ -1,13 +1,23 @@
 import os
 import io
+import sys
+import json
+import time
+import subprocess
 import pytest
+from types import SimpleNamespace
 from app import app
 
 @pytest.fixture
-def client():
+def client(tmp_path):
     app.config['TESTING'] = True
     app.config['UPLOAD_FOLDER'] = 'test_uploads'
     app.config['ORGANIZED_FOLDER'] = 'test_organized'
+    app.config['ANALYSIS_CACHE_PATH'] = ''
+    app.config['JOB_STORE_PATH'] = str(tmp_path / 'jobs.sqlite3')
+    app.config['CATALOG_PATH'] = str(tmp_path / 'catalog.sqlite3')
+    app.config['CATEGORY_INDEX_PATH'] = str(tmp_path / 'categories.sqlite3')
+    app.config['NEAR_DUPLICATE_INDEX_PATH'] = str(tmp_path / 'near_duplicates.sqlite3')
     
     # Create test directories
     os.makedirs('test_uploads', exist_ok=True)
@@ -46,12 +56,972 @@ def test_upload_with_file(client):
     response = client.post('/upload', data=data)
     assert response.status_code == 400  # Should fail because .txt is not allowed
 
-def test_unimplemented_features(client):
-    """Test endpoints that are marked as not implemented"""
+def test_unknown_files_not_found(client):
+    """Download and preview only serve files recorded in the catalog"""
     response = client.get('/preview/test.pdf')
-    assert response.status_code == 501
-    assert b'not implemented yet' in response.data
+    assert response.status_code == 404
+    assert b'File not found' in response.data
 
     response = client.get('/download/test.pdf')
-    assert response.status_code == 501
-    assert b'not implemented yet' in response.data
\ No newline at end of file
+    assert response.status_code == 404
+
+    response = client.get('/download/../app.py')
+    assert response.status_code == 404
+
+def test_organize_files_classifies_concurrently(client, monkeypatch):
+    """Documents are classified in parallel and keep their upload order"""
+    import app as app_module
+
+    def slow_analysis(text):
+        time.sleep(0.3)
+        return {'category': 'Course Work', 'subcategory': 'Data Sets', 'keywords': [text.split()[0]]}
+
+    monkeypatch.setattr(app_module, 'analyze_document_content', slow_analysis)
+    monkeypatch.setitem(app.config, 'LLM_MAX_CONCURRENCY', 5)
+
+    paths = []
+    for i in range(5):
+        path = os.path.join('test_uploads', f'data{i}.csv')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f'word{i},value\n')
+        paths.append(path)
+
+    start = time.monotonic()
+    analyses = app_module.classify_documents(paths)
+    elapsed = time.monotonic() - start
+
+    assert elapsed < 1.0  # serial would take 1.5s
+    assert list(analyses) == paths
+    assert analyses[paths[3]] == {'category': 'Course_Work', 'subcategory': 'Data_Sets', 'keywords': ['word3']}
+
+    stats = app_module.organize_files(paths)
+    assert stats['documents'] == 5
+    assert stats['folder_structure'] == {'Course_Work': ['Data_Sets']}
+    assert os.path.exists(os.path.join('test_organized', 'Documents', 'Course_Work', 'Data_Sets', 'data4.csv'))
+
+def test_llm_concurrency_is_capped_per_process(client, monkeypatch):
+    """Concurrent jobs share one LLM_MAX_CONCURRENCY limit"""
+    import threading
+    import app as app_module
+
+    lock = threading.Lock()
+    in_flight = [0, 0]  # current, peak
+
+    def tracked(kwargs):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight[1], in_flight[0])
+        time.sleep(0.05)
+        with lock:
+            in_flight[0] -= 1
+        return '{"category": "Mathematics", "subcategory": "Exercises", "keywords": []}'
+
+    monkeypatch.setattr(app_module, 'client', fake_client(FakeCompletions(tracked)))
+    monkeypatch.setitem(app.config, 'LLM_MAX_CONCURRENCY', 2)
+    jobs = [threading.Thread(target=app_module.analyze_texts, args=({f'{job}{i}': f'notes {job} {i}' for i in range(4)},))
+            for job in 'ab']
+    for job in jobs:
+        job.start()
+    for job in jobs:
+        job.join()
+    assert in_flight[1] == 2
+
+def test_rate_limiter_paces_requests(monkeypatch):
+    """Requests beyond the per-minute budget wait for the window to slide"""
+    import app as app_module
+
+    clock = [0.0]
+    sleeps = []
+    monkeypatch.setattr(app_module.time, 'monotonic', lambda: clock[0])
+
+    def fake_sleep(seconds):
+        sleeps.append(seconds)
+        clock[0] += seconds
+
+    monkeypatch.setattr(app_module.time, 'sleep', fake_sleep)
+
+    limiter = app_module.RateLimiter()
+    limiter.acquire(100, requests_per_minute=2)
+    limiter.acquire(100, requests_per_minute=2)
+    assert sleeps == []
+    limiter.acquire(100, requests_per_minute=2)
+    assert sum(sleeps) == pytest.approx(60)
+
+    limiter = app_module.RateLimiter()
+    clock[0] = 1000.0
+    sleeps.clear()
+    limiter.acquire(800, tokens_per_minute=1000)
+    limiter.acquire(800, tokens_per_minute=1000)
+    assert sum(sleeps) == pytest.approx(60)
+
+class FakeCompletions:
+    """Stand-in for client.chat.completions that records calls"""
+
+    def __init__(self, content='{"category": "Mathematics", "subcategory": "Exercises", "keywords": ["calculus"]}'):
+        self.content = content
+        self.calls = 0
+
+    def create(self, **kwargs):
+        self.calls += 1
+        if self.content is None:
+            raise RuntimeError('API unavailable')
+        content = self.content(kwargs) if callable(self.content) else self.content
+        message = SimpleNamespace(content=content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+def fake_client(completions):
+    return SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+def test_analysis_cache_skips_repeat_calls(client, monkeypatch, tmp_path):
+    """Identical text is answered from the on-disk cache"""
+    import app as app_module
+
+    completions = FakeCompletions()
+    monkeypatch.setattr(app_module, 'client', fake_client(completions))
+    monkeypatch.setitem(app.config, 'ANALYSIS_CACHE_PATH', str(tmp_path / 'cache.sqlite3'))
+
+    first = app_module.analyze_document_content('derivatives and integrals')
+    second = app_module.analyze_document_content('derivatives and integrals')
+    assert first == second == {'category': 'Mathematics', 'subcategory': 'Exercises', 'keywords': ['calculus']}
+    assert completions.calls == 1
+    assert app_module.get_analysis_cache().stats() == {'hits': 1, 'misses': 1, 'entries': 1}
+
+    # Failed calls fall back to the local classifier and are not cached
+    completions.content = None
+    assert app_module.analyze_document_content('limits')['category'] == 'Limits'
+    assert app_module.analyze_document_content('limits')['category'] == 'Limits'
+    assert completions.calls == 3
+
+    # Replies without the expected fields are treated as failures too
+    completions.content = '{"topic": "Math"}'
+    assert app_module.analyze_document_content('series')['category'] == 'Series'
+    assert app_module.get_analysis_cache().stats()['entries'] == 1
+
+def test_llm_retries_rate_limits_and_opens_breaker(client, monkeypatch):
+    """Rate limits are retried with backoff; repeated failures open the breaker and fall back locally"""
+    import app as app_module
+    import openai
+
+    monkeypatch.setattr(app_module, 'llm_breaker', app_module.CircuitBreaker())
+    monkeypatch.setitem(app.config, 'LLM_BACKOFF_BASE', 0.01)
+    monkeypatch.setitem(app.config, 'LLM_BREAKER_FAILURES', 2)
+    responses = ['429', '429', '{"category": "Mathematics", "subcategory": "Exercises", "keywords": []}']
+
+    def flaky(kwargs):
+        content = responses.pop(0)
+        if content == '429':
+            response = SimpleNamespace(status_code=429, headers={'retry-after': '0'}, request=None)
+            raise openai.RateLimitError('Rate limit reached', response=response, body=None)
+        return content
+
+    completions = FakeCompletions(flaky)
+    monkeypatch.setattr(app_module, 'client', fake_client(completions))
+    assert app_module.analyze_document_content('integrals')['category'] == 'Mathematics'
+    assert completions.calls == 3
+
+    completions.content = None
+    for _ in range(3):
+        assert app_module.analyze_document_content('integrals')['category'] == 'Integrals'
+    assert completions.calls == 5  # the third failure never reached the API
+    assert app_module.llm_breaker.is_open
+
+    monkeypatch.setitem(app.config, 'LLM_BREAKER_COOLDOWN', 0)
+    completions.content = '{"category": "Mathematics", "subcategory": "Exercises", "keywords": []}'
+    assert app_module.analyze_document_content('integrals')['category'] == 'Mathematics'
+    assert not app_module.llm_breaker.is_open
+
+def test_fallback_guesses_are_not_learned(client, monkeypatch):
+    """Locally guessed categories are used for placement but never indexed"""
+    import app as app_module
+
+    completions = FakeCompletions(None)
+    monkeypatch.setattr(app_module, 'client', fake_client(completions))
+    monkeypatch.setattr(app_module, 'llm_breaker', app_module.CircuitBreaker())
+    path = os.path.join('test_uploads', 'limits.csv')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(' '.join(f'limits epsilon delta proof {i}' for i in range(30)) + '\n')
+
+    stats = app_module.organize_files([path])
+    assert stats['documents'] == 1 and stats['folder_structure']
+    assert not app_module.get_category_index().folders()
+    signature = app_module.minhash_signature(' '.join(f'limits epsilon delta proof {i}' for i in range(30)))
+    assert app_module.get_near_duplicate_index().query(signature) == []
+
+def test_llm_hedges_slow_requests_within_deadline(client, monkeypatch):
+    """A request slower than the hedging percentile is raced by a duplicate, and no call outlives the deadline"""
+    import app as app_module
+
+    monkeypatch.setattr(app_module, 'llm_latency', app_module.LatencyWindow())
+    for _ in range(20):
+        app_module.llm_latency.add(0.05)
+    monkeypatch.setitem(app.config, 'LLM_HEDGE_PERCENTILE', 95)
+
+    def first_call_stalls(kwargs):
+        if completions.calls == 1:
+            time.sleep(1)
+        return '{"category": "Mathematics", "subcategory": "Exercises", "keywords": []}'
+
+    completions = FakeCompletions(first_call_stalls)
+    monkeypatch.setattr(app_module, 'client', fake_client(completions))
+    start = time.monotonic()
+    assert app_module.analyze_document_content('limits')['category'] == 'Mathematics'
+    assert time.monotonic() - start < 0.5
+    assert completions.calls == 2
+
+    monkeypatch.setattr(app_module, 'llm_breaker', app_module.CircuitBreaker())
+    monkeypatch.setitem(app.config, 'LLM_HEDGE_PERCENTILE', 0)
+    monkeypatch.setitem(app.config, 'LLM_DEADLINE', 0.3)
+    completions.content = lambda kwargs: time.sleep(1) or '{}'
+    start = time.monotonic()
+    assert app_module.analyze_document_content('limits')['category'] == 'Limits'
+    assert time.monotonic() - start < 0.8
+
+def test_rate_limit_waits_do_not_count_against_deadline(client, monkeypatch):
+    """Waiting for our own rate limits neither times out a request nor trips the breaker"""
+    import app as app_module
+
+    class SlowLimiter:
+        def acquire(self, tokens, requests_per_minute=0, tokens_per_minute=0, blocking=True):
+            if blocking:
+                time.sleep(0.3)
+            return blocking
+
+    monkeypatch.setattr(app_module, 'llm_rate_limiter', SlowLimiter())
+    monkeypatch.setattr(app_module, 'llm_breaker', app_module.CircuitBreaker())
+    monkeypatch.setitem(app.config, 'LLM_TIMEOUT', 0.1)
+    monkeypatch.setitem(app.config, 'LLM_DEADLINE', 0.2)
+    monkeypatch.setitem(app.config, 'LLM_BREAKER_FAILURES', 1)
+    completions = FakeCompletions()
+    monkeypatch.setattr(app_module, 'client', fake_client(completions))
+    for _ in range(2):
+        assert app_module.analyze_document_content('integrals')['category'] == 'Mathematics'
+    assert not app_module.llm_breaker.is_open
+
+def test_llm_attempts_queued_for_a_slot_do_not_time_out(client, monkeypatch):
+    """The attempt clock starts when a request is sent, not while it waits for a free slot"""
+    import threading
+    import app as app_module
+
+    def slow(kwargs):
+        time.sleep(0.1)
+        return '{"category": "Mathematics", "subcategory": "Exercises", "keywords": []}'
+
+    monkeypatch.setattr(app_module, 'client', fake_client(FakeCompletions(slow)))
+    monkeypatch.setattr(app_module, 'llm_breaker', app_module.CircuitBreaker())
+    monkeypatch.setitem(app.config, 'LLM_MAX_CONCURRENCY', 1)
+    monkeypatch.setitem(app.config, 'LLM_TIMEOUT', 0.15)
+    monkeypatch.setitem(app.config, 'LLM_MAX_RETRIES', 0)
+    results = []
+    callers = [threading.Thread(target=lambda i=i: results.append(app_module.analyze_document_content(f'notes {i}')))
+               for i in range(4)]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+    assert [result['category'] for result in results] == ['Mathematics'] * 4
+    assert not app_module.llm_breaker.is_open
+
+def test_analysis_cache_eviction(tmp_path):
+    """Least recently used and expired entries are evicted"""
+    import app as app_module
+
+    cache = app_module.AnalysisCache(str(tmp_path / 'cache.sqlite3'), max_entries=2)
+    cache.put('a', {'category': 'A'})
+    cache.put('b', {'category': 'B'})
+    assert cache.get('a') == {'category': 'A'}
+    cache.put('c', {'category': 'C'})
+    assert cache.get('b') is None
+    assert cache.get('a') == {'category': 'A'}
+    assert cache.stats()['entries'] == 2
+
+    cache = app_module.AnalysisCache(str(tmp_path / 'cache.sqlite3'), max_age_days=0)
+    assert cache.get('a') is None
+    assert app_module.AnalysisCache.make_key('x') != app_module.AnalysisCache.make_key('x', prompt_version=0)
+
+SAMPLE_PDFS = ['Calculus1.pdf', 'Calculus2.pdf', 'Calculus3.pdf', 'EnglishAssignment1.pdf', 'EnglishAssignment2.pdf']
+
+def sample_paths():
+    return [os.path.join(os.path.dirname(__file__), 'samplefiles', name) for name in SAMPLE_PDFS]
+
+def test_cluster_mode_calls_llm_once_per_cluster(client, monkeypatch):
+    """Cluster mode only analyzes one representative document per cluster"""
+    import app as app_module
+
+    calls = []
+
+    def fake_analysis(text):
+        calls.append(text)
+        return {'category': f'Group {len(calls)}', 'subcategory': 'Notes', 'keywords': []}
+
+    monkeypatch.setattr(app_module, 'analyze_document_content', fake_analysis)
+    monkeypatch.setitem(app.config, 'ORGANIZER_MODE', 'cluster')
+    analyses = app_module.classify_documents(sample_paths())
+
+    categories = [analyses[path]['category'] for path in sample_paths()]
+    assert len(calls) == 2
+    assert categories[0] == categories[1] == categories[2]
+    assert categories[3] == categories[4] != categories[0]
+    assert analyses[sample_paths()[0]]['subcategory'] == 'Notes'
+
+def test_offline_mode_names_clusters_by_terms(client, monkeypatch):
+    """Offline mode never calls the LLM and names folders from TF-IDF terms"""
+    import app as app_module
+
+    def no_network(text):
+        raise AssertionError('LLM should not be called offline')
+
+    monkeypatch.setattr(app_module, 'analyze_document_content', no_network)
+    monkeypatch.setitem(app.config, 'ORGANIZER_MODE', 'offline')
+    analyses = app_module.classify_documents(sample_paths())
+
+    calculus, english = analyses[sample_paths()[0]], analyses[sample_paths()[3]]
+    assert calculus == analyses[sample_paths()[2]]
+    assert english == analyses[sample_paths()[4]]
+    assert calculus['category'] != english['category']
+    assert len(english['keywords']) == 5
+    assert ' ' not in calculus['subcategory']
+
+def test_new_documents_join_existing_categories(client, monkeypatch):
+    """Documents near a learned centroid skip analysis and new names reuse existing folders"""
+    import app as app_module
+
+    calls = []
+
+    def fake_analysis(text):
+        calls.append(text)
+        return {'category': 'mathematics', 'subcategory': 'Exercise', 'keywords': ['poem']}
+
+    monkeypatch.setattr(app_module, 'analyze_document_content', fake_analysis)
+    index = app_module.get_category_index()
+    index.add([('Mathematics', 'Exercises', 'integral derivative calculus limit equation', ['calculus'])] * 3)
+
+    paths = []
+    for name, text in (('calc.csv', 'calculus,integral,derivative,limit'), ('poem.csv', 'sonnet,verse,rhyme')):
+        path = os.path.join('test_uploads', name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        paths.append(path)
+
+    analyses = app_module.classify_documents(paths)
+    assert len(calls) == 1 and 'sonnet' in calls[0]
+    assert analyses[paths[0]] == {'category': 'Mathematics', 'subcategory': 'Exercises', 'keywords': ['calculus']}
+    assert analyses[paths[1]]['category'] == 'Mathematics'
+    assert analyses[paths[1]]['subcategory'] == 'Exercises'
+    assert app_module.folder_key('Course Materials') == app_module.folder_key('course_material')
+
+def test_near_duplicates_inherit_category(client, monkeypatch):
+    """Revised drafts reuse the analysis of an earlier draft in the same or a later upload"""
+    import app as app_module
+
+    calls = []
+
+    def fake_analysis(text):
+        calls.append(text)
+        return {'category': 'Language', 'subcategory': 'Assignments', 'keywords': ['essay']}
+
+    monkeypatch.setattr(app_module, 'analyze_document_content', fake_analysis)
+    words = [f'w{i}' for i in range(300)]
+
+    def write_draft(name, changed_every):
+        path = os.path.join('test_uploads', name)
+        draft = [word if i % changed_every else 'revised' for i, word in enumerate(words)]
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(' '.join(draft) + '\n')
+        return path
+
+    stats = app_module.organize_files([write_draft('draft.csv', 1000), write_draft('draft_v2.csv', 60)])
+    assert len(calls) == 1
+    assert stats['folder_structure'] == {'Language': ['Assignments']}
+    assert [entry['file'] for entry in stats['near_duplicates']] == ['draft_v2.csv']
+    assert stats['near_duplicates'][0]['similar_to'] == 'draft.csv'
+    assert stats['near_duplicates'][0]['similarity'] >= 0.8
+
+    stats = app_module.organize_files([write_draft('draft_v3.csv', 50)])
+    assert len(calls) == 1
+    assert stats['near_duplicates'][0]['similar_to'] in (
+        os.path.join('Documents', 'Language', 'Assignments', 'draft.csv'),
+        os.path.join('Documents', 'Language', 'Assignments', 'draft_v2.csv'),
+    )
+
+def test_prompt_excerpt_skips_boilerplate(client, monkeypatch):
+    """Prompts carry the most representative sentences within the token budget"""
+    import app as app_module
+
+    header = 'Copyright notice for this course reader. All rights reserved by the publisher. '
+    body = ' '.join(f'The derivative of the integral gives the function back in example {i}.' for i in range(40))
+    text = header * 30 + body
+    monkeypatch.setitem(app.config, 'PROMPT_TOKEN_BUDGET', 100)
+    excerpt = app_module.prompt_excerpt(text)
+    assert app_module.estimate_tokens(excerpt) <= 101
+    assert 'derivative' in excerpt
+    assert excerpt.count('Copyright') <= 1
+
+    monkeypatch.setitem(app.config, 'PROMPT_TOKEN_BUDGET', 0)
+    assert app_module.prompt_excerpt(text) == text[:10000]
+    assert app_module.excerpt_text('short text', 100) == 'short text'
+
+def test_cluster_texts_handles_small_batches():
+    """Single documents and stopword-only text still get a cluster label"""
+    import app as app_module
+
+    assert app_module.cluster_texts(['integrals'], 0.85)[0] == [1]
+    labels, matrix, _ = app_module.cluster_texts(['the and', 'of the'], 0.85)
+    assert labels == [1, 2] and matrix is None
+
+def test_batched_analysis_packs_documents(client, monkeypatch):
+    """Several documents share one request and malformed entries fall back to single calls"""
+    import app as app_module
+
+    def batch_response(kwargs):
+        if 'Document 0' not in kwargs['messages'][1]['content']:
+            return '{"category": "Single", "subcategory": "Call", "keywords": []}'
+        return json.dumps({'results': [
+            {'id': '0', 'category': 'Mathematics', 'subcategory': 'Exercises', 'keywords': ['limits']},
+            {'id': 1, 'category': 'Language', 'subcategory': 'Assignments', 'keywords': 'bad'},
+            {'id': '2', 'category': None},
+        ]})
+
+    completions = FakeCompletions(batch_response)
+    monkeypatch.setattr(app_module, 'client', fake_client(completions))
+    monkeypatch.setitem(app.config, 'LLM_BATCH_SIZE', 10)
+
+    results = app_module.analyze_texts({'a': 'limits', 'b': 'essay', 'c': 'poem'})
+    assert completions.calls == 2  # one batch plus one fallback for the malformed entry
+    assert results['a'] == {'category': 'Mathematics', 'subcategory': 'Exercises', 'keywords': ['limits']}
+    assert results['b'] == {'category': 'Language', 'subcategory': 'Assignments', 'keywords': []}
+    assert results['c']['category'] == 'Single'
+
+    # Documents from a failed batch are retried side by side, not one after another
+    def slow_singles(kwargs):
+        if 'Document 0' in kwargs['messages'][1]['content']:
+            return 'not json'
+        time.sleep(0.3)
+        return '{"category": "Single", "subcategory": "Call", "keywords": []}'
+
+    completions.content = slow_singles
+    monkeypatch.setitem(app.config, 'LLM_MAX_CONCURRENCY', 4)
+    start = time.monotonic()
+    results = app_module.analyze_texts({key: f'notes {key}' for key in 'defg'})
+    assert time.monotonic() - start < 0.9
+    assert {result['category'] for result in results.values()} == {'Single'}
+
+def test_plan_batches_respects_limits():
+    """Batches are bounded by document count and token budget"""
+    import app as app_module
+
+    texts = {i: 'x' * 400 for i in range(5)}  # ~101 tokens each
+    assert [len(b) for b in app_module.plan_batches(texts, 2, 10000)] == [2, 2, 1]
+    assert [len(b) for b in app_module.plan_batches(texts, 10, 250)] == [2, 2, 1]
+    assert [len(b) for b in app_module.plan_batches(texts, 10, 50)] == [1, 1, 1, 1, 1]
+
+def test_extraction_stops_at_character_budget():
+    """Chunks after the budget is met are never read"""
+    import app as app_module
+
+    consumed = []
+
+    def chunks():
+        for i in range(1000):
+            consumed.append(i)
+            yield i, 'x' * 99
+
+    text = app_module.take_chars(chunks(), 1000)
+    assert len(text) == 1000
+    assert len(consumed) == 11
+
+def test_extract_large_csv_reads_prefix_only(tmp_path):
+    """A large CSV is cut at the budget without building the whole string"""
+    import app as app_module
+
+    path = tmp_path / 'large.csv'
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(200000):
+            f.write(f'row{i},value{i}\n')
+
+    text = app_module.extract_words_from_file(str(path), max_chars=500)
+    assert len(text) == 500
+    assert text.startswith('row0 value0 row1 value1')
+
+def test_spread_sampling_covers_whole_pdf():
+    """Spread sampling pulls pages from across the document in page order"""
+    import app as app_module
+
+    assert sorted(app_module.spread_order(7)) == list(range(7))
+    assert list(app_module.spread_order(8))[:4] == [0, 4, 2, 6]
+
+    path = sample_paths()[3]
+    head = app_module.extract_words_from_file(path, max_chars=3000, sampling='head')
+    spread = app_module.extract_words_from_file(path, max_chars=3000, sampling='spread')
+    assert head.startswith('Classroom warmers')
+    assert spread.startswith('Classroom warmers')
+    assert head != spread
+
+def use_forked_extractors(monkeypatch):
+    """Extract in a new forked pool, whose workers see the extractors patched so far"""
+    import app as app_module
+
+    if app_module._extract_pool is not None:
+        app_module.retire_extract_pool(app_module._extract_pool)
+    monkeypatch.setitem(app.config, 'EXTRACT_START_METHOD', 'fork')
+
+def test_extract_documents_in_process_pool(monkeypatch, tmp_path):
+    """Extraction runs in worker processes and a hanging file only costs its timeout"""
+    import app as app_module
+
+    def slow_csv(filepath, sampling='head'):
+        if 'hang' in filepath:
+            time.sleep(30)
+        yield 0, os.path.basename(filepath)
+
+    monkeypatch.setitem(app_module.TEXT_EXTRACTORS, '.csv', slow_csv)
+    monkeypatch.setitem(app.config, 'EXTRACT_WORKERS', 2)
+    monkeypatch.setitem(app.config, 'EXTRACT_TIMEOUT', 1)
+    use_forked_extractors(monkeypatch)
+    timeouts = app_module.metrics.value('organizer_extract_timeouts_total')
+
+    paths = [str(tmp_path / name) for name in ('hang.csv', 'a.csv', 'b.csv')]
+    start = time.monotonic()
+    results = list(app_module.extract_documents(paths))
+    elapsed = time.monotonic() - start
+
+    assert elapsed < 10
+    assert dict(results) == {paths[0]: '', paths[1]: 'a.csv', paths[2]: 'b.csv'}
+    assert results[-1][0] == paths[0]  # completed files are yielded first
+    assert app_module.metrics.value('organizer_extract_timeouts_total') == timeouts + 1
+
+def test_single_document_extraction_still_times_out(monkeypatch, tmp_path):
+    """A lone hanging file is extracted in the pool too, so its timeout applies"""
+    import app as app_module
+
+    def hang(filepath, sampling='head'):
+        time.sleep(30)
+        yield 0, 'never'
+
+    monkeypatch.setitem(app_module.TEXT_EXTRACTORS, '.csv', hang)
+    monkeypatch.setitem(app.config, 'EXTRACT_WORKERS', 2)
+    monkeypatch.setitem(app.config, 'EXTRACT_TIMEOUT', 1)
+    use_forked_extractors(monkeypatch)
+    path = str(tmp_path / 'hang.csv')
+    start = time.monotonic()
+    assert list(app_module.extract_documents([path])) == [(path, '')]
+    assert time.monotonic() - start < 4
+
+def test_extract_documents_reuses_pool_started_without_fork(monkeypatch):
+    """The default pool starts workers without forking the server and is kept between uploads"""
+    import app as app_module
+
+    monkeypatch.setitem(app.config, 'EXTRACT_WORKERS', 2)
+    assert app.config['EXTRACT_START_METHOD'] != 'fork'
+    first = dict(app_module.extract_documents(sample_paths()[:2]))
+    pool = app_module.get_extract_pool()
+    second = dict(app_module.extract_documents(sample_paths()[:2]))
+    assert first == second
+    assert first[sample_paths()[0]].startswith('MIT OpenCourseWare')
+    assert app_module.get_extract_pool() is pool
+
+def test_extract_documents_single_worker_runs_inline(monkeypatch):
+    """With one worker extraction stays in-process and keeps document order"""
+    import app as app_module
+
+    monkeypatch.setitem(app.config, 'EXTRACT_WORKERS', 1)
+    results = list(app_module.extract_documents(sample_paths()[:2]))
+    assert [doc for doc, _ in results] == sample_paths()[:2]
+    assert results[0][1].startswith('MIT OpenCourseWare')
+
+def wait_for_job(client, job_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = client.get(f'/jobs/{job_id}').get_json()
+        if job['status'] in ('completed', 'failed'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError('job did not finish')
+
+def sync_upload(monkeypatch, analysis=None):
+    """Organize uploads within the request, classifying documents with analysis if given"""
+    import app as app_module
+
+    if analysis is not None:
+        monkeypatch.setattr(app_module, 'analyze_document_content', analysis)
+    monkeypatch.setitem(app.config, 'UPLOAD_ASYNC', False)
+    monkeypatch.setenv('OPENAI_API_KEY', 'test-key')
+
+def test_upload_queues_job_and_reports_progress(client, monkeypatch):
+    """Uploads return a job id immediately and /jobs reports the final stats"""
+    import app as app_module
+
+    def fake_analysis(text):
+        return {'category': 'Data', 'subcategory': 'Tables', 'keywords': []}
+
+    monkeypatch.setattr(app_module, 'analyze_document_content', fake_analysis)
+    monkeypatch.setenv('OPENAI_API_KEY', 'test-key')
+    data = {'files[]': [(io.BytesIO(b'name,score\nada,10\n'), 'scores.csv'),
+                        (io.BytesIO(b'\x89PNG'), 'photo.png')]}
+    response = client.post('/upload', data=data)
+    assert response.status_code == 202
+    body = response.get_json()
+    assert body['status_url'] == f"/jobs/{body['job_id']}"
+
+    job = wait_for_job(client, body['job_id'])
+    assert job['status'] == 'completed'
+    assert job['files'] == {'scores.csv': 'organized', 'photo.png': 'organized'}
+    assert job['progress'] == {'done': 2, 'total': 2}
+    assert job['stats']['folder_structure'] == {'Data': ['Tables']}
+    assert os.path.exists(os.path.join('test_organized', 'Documents', 'Data', 'Tables', 'scores.csv'))
+    assert not os.path.exists(os.path.join('test_uploads', body['job_id']))
+
+    events = client.get(f"/jobs/{body['job_id']}/events")
+    assert events.mimetype == 'text/event-stream'
+    assert b'"status": "completed"' in events.data
+
+def test_upload_sync_mode_and_missing_job(client, monkeypatch):
+    """With UPLOAD_ASYNC off the upload is organized in the request"""
+    monkeypatch.setitem(app.config, 'UPLOAD_ASYNC', False)
+    monkeypatch.setitem(app.config, 'ORGANIZER_MODE', 'offline')
+    monkeypatch.delenv('OPENAI_API_KEY', raising=False)
+    data = {'files[]': (io.BytesIO(b'calculus calculus,derivative\n'), 'math.csv')}
+    response = client.post('/upload', data=data)
+    assert response.status_code == 200
+    assert response.get_json()['stats']['folder_structure'] == {'Calculus': ['Derivative']}
+
+    assert client.get('/jobs/unknown').status_code == 404
+
+    # Renamed copies never collide with another file's name
+    data = {'files[]': [(io.BytesIO(b'calculus,one\n'), 'a_2.csv'), (io.BytesIO(b'calculus,two\n'), 'a.csv'),
+                        (io.BytesIO(b'calculus,three\n'), 'a.csv')]}
+    response = client.post('/upload', data=data)
+    assert response.status_code == 200
+    assert response.get_json()['stats']['documents'] == 3
+
+def test_chunked_upload_resumes_and_verifies_checksums(client, monkeypatch):
+    """Chunks land at their offsets, bad checksums are refused and the finished file is organized"""
+    import hashlib
+
+    def fake_analysis(text):
+        return {'category': 'Data', 'subcategory': 'Tables', 'keywords': []}
+
+    sync_upload(monkeypatch, fake_analysis)
+    content = b''.join(b'row%d,%d\n' % (i, i * i) for i in range(40))
+    digest = hashlib.sha256(content).hexdigest()
+
+    response = client.post('/uploads', json={'chunk_size': 100, 'files': [
+        {'name': 'export.csv', 'size': len(content), 'sha256': digest}
+    ]})
+    assert response.status_code == 201
+    session = response.get_json()
+    upload_id = session['upload_id']
+    assert session['files'][0]['missing'] == list(range(session['files'][0]['chunks']))
+    assert client.post('/uploads', json={'files': [{'name': 'run.exe', 'size': 1}]}).status_code == 400
+    renamed = client.post('/uploads', json={'files': [
+        {'name': 'a_2.csv', 'size': 10}, {'name': 'a.csv', 'size': 7}, {'name': 'a.csv', 'size': 7}
+    ]}).get_json()
+    assert [entry['name'] for entry in renamed['files']] == ['a_2.csv', 'a.csv', 'a_1.csv']
+
+    def put(chunk, body=None):
+        body = body if body is not None else content[chunk * 100:(chunk + 1) * 100]
+        return client.put(f'/uploads/{upload_id}/files/0/chunks/{chunk}', data=body,
+                          headers={'X-Chunk-SHA256': hashlib.sha256(content[chunk * 100:(chunk + 1) * 100]).hexdigest()})
+
+    # Out of order, with one corrupted chunk that must be sent again
+    assert put(2).status_code == 200
+    assert put(0, b'x' * 100).status_code == 400
+    assert put(0).status_code == 200
+    assert client.post(f'/uploads/{upload_id}/complete').status_code == 409
+    missing = client.get(f'/uploads/{upload_id}').get_json()['files'][0]['missing']
+    assert 0 not in missing and 2 not in missing
+    for chunk in missing:
+        assert put(chunk).status_code == 200
+
+    response = client.post(f'/uploads/{upload_id}/complete')
+    assert response.status_code == 200
+    assert response.get_json()['stats']['folder_structure'] == {'Data': ['Tables']}
+    with open(os.path.join('test_organized', 'Documents', 'Data', 'Tables', 'export.csv'), 'rb') as f:
+        assert f.read() == content
+    assert client.get(f'/uploads/{upload_id}').get_json()['job_url'] == f'/jobs/{upload_id}'
+    assert put(0).status_code == 409
+
+    # A file that does not match its declared checksum fails the job, not the request
+    upload_id = client.post('/uploads', json={'chunk_size': 100, 'files': [
+        {'name': 'other.csv', 'size': 100, 'sha256': '0' * 64}
+    ]}).get_json()['upload_id']
+    assert put(0).status_code == 200
+    response = client.post(f'/uploads/{upload_id}/complete')
+    assert response.status_code == 500
+    assert 'Checksum mismatch for other.csv' in response.get_json()['error']
+    assert not os.path.exists(os.path.join('test_uploads', upload_id))
+
+def test_stale_jobs_fail_and_event_streams_end(client, monkeypatch):
+    """Jobs whose server stopped sending heartbeats fail, old jobs are pruned and event streams are capped"""
+    import app as app_module
+
+    store = app_module.get_job_store()
+    store.create('orphan', ['a.csv'], 'restarted-worker')
+    store.create('alive', ['b.csv'], app_module.job_worker_id())
+    store.create('old', ['c.csv'])
+    store.update('old', status='completed')
+    with store._lock:
+        store._conn.execute("UPDATE jobs SET heartbeat = heartbeat - 600 WHERE id = 'orphan'")
+        store._conn.execute("UPDATE jobs SET updated = updated - 30 * 86400 WHERE id = 'old'")
+        store._conn.commit()
+
+    monkeypatch.setattr(app_module, '_jobs_expired_at', float('-inf'))
+    orphan = client.get('/jobs/orphan').get_json()
+    assert orphan['status'] == 'failed' and 'interrupted' in orphan['error']
+    assert client.get('/jobs/old').status_code == 404
+    assert client.get('/jobs/alive').get_json()['status'] == 'queued'
+
+    monkeypatch.setitem(app.config, 'JOB_EVENTS_MAX_SECONDS', 0.2)
+    start = time.monotonic()
+    events = client.get('/jobs/alive/events')
+    assert events.data.count(b'data:') == 1
+    assert time.monotonic() - start < 2
+
+def test_reuploaded_content_is_skipped(client, monkeypatch):
+    """Identical content is detected by hash and same-named files are never overwritten"""
+    calls = []
+
+    def fake_analysis(text):
+        calls.append(text)
+        return {'category': 'Data', 'subcategory': 'Tables', 'keywords': []}
+
+    sync_upload(monkeypatch, fake_analysis)
+
+    first = client.post('/upload', data={'files[]': [
+        (io.BytesIO(b'ada,10\n'), 'scores.csv'),
+        (io.BytesIO(b'ada,10\n'), 'copy.csv'),
+    ]}).get_json()
+    assert first['stats']['documents'] == 1
+    assert first['stats']['duplicates'] == [{'file': 'copy.csv', 'existing': 'scores.csv'}]
+
+    second = client.post('/upload', data={'files[]': [
+        (io.BytesIO(b'ada,10\n'), 'again.csv'),
+        (io.BytesIO(b'bob,7\n'), 'scores.csv'),
+    ]}).get_json()
+    assert second['stats']['duplicates'] == [
+        {'file': 'again.csv', 'existing': os.path.join('Documents', 'Data', 'Tables', 'scores.csv')}
+    ]
+    assert len(calls) == 2
+
+    folder = os.path.join('test_organized', 'Documents', 'Data', 'Tables')
+    assert sorted(os.listdir(folder)) == ['scores.csv', 'scores_1.csv']
+    with open(os.path.join(folder, 'scores.csv'), 'rb') as f:
+        assert f.read() == b'ada,10\n'
+
+def test_move_file_does_not_clobber(tmp_path):
+    """Moves claim a free name atomically instead of overwriting"""
+    import app as app_module
+
+    (tmp_path / 'dest').mkdir()
+    (tmp_path / 'dest' / 'a.pdf').write_bytes(b'old')
+    (tmp_path / 'a.pdf').write_bytes(b'new')
+
+    dest = app_module.move_file(str(tmp_path / 'a.pdf'), str(tmp_path / 'dest'), 'a.pdf')
+    assert dest == str(tmp_path / 'dest' / 'a_1.pdf')
+    assert (tmp_path / 'dest' / 'a.pdf').read_bytes() == b'old'
+    assert (tmp_path / 'dest' / 'a_1.pdf').read_bytes() == b'new'
+    assert not (tmp_path / 'a.pdf').exists()
+
+def test_benchmark_smoke(tmp_path):
+    """The benchmark harness runs every stage against the mock OpenAI server"""
+    import benchmark
+
+    args = benchmark.parse_args([
+        '--documents', '3', '--images', '1', '--words', '200', '--latency-ms', '0', '--jitter-ms', '0',
+        '--batch-size', '2', '--extract-workers', '1', '--workdir', str(tmp_path)
+    ])
+    original_folder = app.config['ORGANIZED_FOLDER']
+    results = benchmark.run_benchmark(args)
+
+    assert [r['stage'] for r in results] == ['extract', 'classify', 'organize', 'upload']
+    assert results[0]['count'] == 3 and results[2]['units'] == 4
+    assert results[-1]['llm_requests'] >= 3
+    assert app.config['ORGANIZED_FOLDER'] == original_folder
+    assert os.listdir(tmp_path / 'organized' / 'Documents')
+    assert benchmark.percentile([5, 1, 3, 2, 4], 50) == 3
+    assert benchmark.percentile([5, 1, 3, 2, 4], 99) == 5
+
+def test_metrics_endpoint_and_timings(client, monkeypatch):
+    """Stage timings and OpenAI usage are exposed on /metrics and per upload"""
+    import app as app_module
+
+    completions = FakeCompletions()
+    original_create = completions.create
+
+    def create_with_usage(**kwargs):
+        response = original_create(**kwargs)
+        response.usage = SimpleNamespace(prompt_tokens=120, completion_tokens=15)
+        return response
+
+    completions.create = create_with_usage
+    monkeypatch.setattr(app_module, 'client', fake_client(completions))
+    sync_upload(monkeypatch)
+    before = app_module.metrics.value('organizer_llm_tokens_total', type='prompt')
+
+    response = client.post('/upload?timings=1', data={'files[]': (io.BytesIO(b'limits,derivatives\n'), 'calc.csv')})
+    timings = response.get_json()['stats']['timings']
+    assert set(timings) == {'dedup', 'extract', 'classify', 'move', 'total'}
+    assert timings['total'] >= timings['classify']
+
+    response = client.post('/upload', data={'files[]': (io.BytesIO(b'series,sums\n'), 'series.csv')})
+    assert 'timings' not in response.get_json()['stats']
+
+    assert app_module.metrics.value('organizer_llm_tokens_total', type='prompt') == before + 240
+    body = client.get('/metrics').get_data(as_text=True)
+    assert '# TYPE organizer_stage_seconds histogram' in body
+    assert 'organizer_stage_seconds_bucket{stage="extract",le="+Inf"}' in body
+    assert 'organizer_stage_seconds_count{stage="move"}' in body
+    assert 'organizer_llm_requests_total{kind="single",outcome="success"}' in body
+    assert 'organizer_files_total{type="document"}' in body
+
+def test_download_and_preview_from_catalog(client, monkeypatch):
+    """Organized files are downloadable with ranges and previewed from cached snippets"""
+    import app as app_module
+
+    sync_upload(monkeypatch, lambda text: {'category': 'Data', 'subcategory': 'Tables', 'keywords': ['scores']})
+    client.post('/upload', data={'files[]': (io.BytesIO(b'name,score\nada,10\n'), 'scores.csv')})
+
+    path = 'Documents/Data/Tables/scores.csv'
+    response = client.get(f'/download/{path}')
+    assert response.status_code == 200
+    assert response.data == b'name,score\nada,10\n'
+    assert 'attachment' in response.headers['Content-Disposition']
+
+    response = client.get(f'/download/{path}', headers={'Range': 'bytes=5-9'})
+    assert response.status_code == 206
+    assert response.data == b'score'
+
+    # The preview must come from the catalog, not from re-parsing the file
+    monkeypatch.setattr(app_module, 'extract_words_from_file', lambda *args: pytest.fail('file re-parsed'))
+    preview = client.get(f'/preview/{path}').get_json()
+    assert preview['snippet'] == 'name score ada 10'
+    assert preview['keywords'] == ['scores']
+    assert preview['download_url'] == f'/download/{path}'
+    assert 'thumbnail_url' not in preview
+
+def test_image_thumbnails_are_cached(client, monkeypatch, tmp_path):
+    """Image previews get a lazily generated, size-bounded thumbnail cache"""
+    from PIL import Image
+
+    sync_upload(monkeypatch)
+    monkeypatch.setitem(app.config, 'PREVIEW_CACHE_FOLDER', str(tmp_path / 'previews'))
+
+    images = []
+    for color in ('red', 'blue'):
+        data = io.BytesIO()
+        Image.new('RGB', (800, 600), color).save(data, 'PNG')
+        images.append((io.BytesIO(data.getvalue()), f'{color}.png'))
+    client.post('/upload', data={'files[]': images})
+
+    preview = client.get('/preview/Images/red.png').get_json()
+    response = client.get(preview['thumbnail_url'])
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert max(Image.open(io.BytesIO(response.data)).size) == 256
+    assert len(os.listdir(tmp_path / 'previews')) == 1
+
+    monkeypatch.setitem(app.config, 'PREVIEW_CACHE_MAX_BYTES', 1)
+    client.get('/thumbnail/Images/blue.png')
+    assert len(os.listdir(tmp_path / 'previews')) == 1
+
+def test_search_ranks_and_filters(client, monkeypatch):
+    """Search uses extracted text and keywords, ranks by BM25 and filters by category"""
+    def fake_analysis(text):
+        if 'poetry' in text:
+            return {'category': 'Language', 'subcategory': 'Assignments', 'keywords': ['essay']}
+        return {'category': 'Mathematics', 'subcategory': 'Exercises', 'keywords': ['calculus']}
+
+    sync_upload(monkeypatch, fake_analysis)
+    client.post('/upload', data={'files[]': [
+        (io.BytesIO(b'integral,integral,integral,area\n'), 'integrals.csv'),
+        (io.BytesIO(b'integral,series,limits\n'), 'series.csv'),
+        (io.BytesIO(b'essay about an integral part of poetry\n'), 'poetry.csv'),
+    ]})
+
+    results = client.get('/search?q=Integrals').get_json()['results']
+    assert [r['path'] for r in results][:2] == ['Documents/Mathematics/Exercises/integrals.csv',
+                                                'Documents/Mathematics/Exercises/series.csv']
+    assert len(results) == 3
+    assert '[integral]' in results[0]['snippet']
+    assert results[0]['score'] >= results[1]['score']
+
+    results = client.get('/search?q=integral&category=Language').get_json()['results']
+    assert [r['path'] for r in results] == ['Documents/Language/Assignments/poetry.csv']
+
+    results = client.get('/search?q=calculus limits').get_json()['results']
+    assert [r['path'] for r in results] == ['Documents/Mathematics/Exercises/series.csv']
+
+    assert client.get('/search?q=NEAR("').get_json()['results'] == []
+    assert client.get('/search').status_code == 400
+
+def test_export_streams_zip_of_folder(client, monkeypatch):
+    """A catalogued folder is streamed as a ZIP, storing already-compressed formats"""
+    import zipfile
+    import app as app_module
+
+    sync_upload(monkeypatch)
+    with open(sample_paths()[0], 'rb') as f:
+        pdf = f.read()
+    monkeypatch.setattr(app_module, 'classify_documents', lambda documents, *args: {
+        doc: {'category': 'Data', 'subcategory': 'Tables', 'keywords': []} for doc in documents
+    })
+    client.post('/upload', data={'files[]': [
+        (io.BytesIO(b'a,b\n' * 1000), 'table.csv'),
+        (io.BytesIO(pdf), 'notes.pdf'),
+        (io.BytesIO(b'\x89PNG'), 'photo.png'),
+    ]})
+
+    response = client.get('/export/Documents/Data')
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.headers['Content-Disposition'] == 'attachment; filename="Documents_Data.zip"'
+
+    archive = zipfile.ZipFile(io.BytesIO(response.get_data()))
+    assert archive.testzip() is None
+    assert archive.namelist() == ['Tables/notes.pdf', 'Tables/table.csv']
+    assert archive.read('Tables/notes.pdf') == pdf
+    assert archive.getinfo('Tables/notes.pdf').compress_type == zipfile.ZIP_STORED
+    assert archive.getinfo('Tables/table.csv').compress_type == zipfile.ZIP_DEFLATED
+
+    assert client.get('/export/Documents/Dat').status_code == 404
+    assert client.get('/export/Images').status_code == 200
+
+def test_import_defers_heavy_dependencies():
+    """Importing the app loads no heavy modules and needs no API key"""
+    env = {key: value for key, value in os.environ.items()
+           if key not in ('OPENAI_API_KEY', 'PRELOAD_DEPENDENCIES')}
+    probe = ('import sys, app; '
+             'print(sorted(m for m in app.HEAVY_MODULES if m in sys.modules)); '
+             'app.preload_dependencies(); '
+             'print(sorted(m for m in app.HEAVY_MODULES if m not in sys.modules))')
+    result = subprocess.run([sys.executable, '-c', probe], env=env, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    assert result.stdout.split('\n')[:2] == ['[]', '[]']
+
+def test_ingest_resumes_from_checkpoint(client, monkeypatch, tmp_path):
+    """Bulk ingest organizes a directory tree and skips checkpointed files on rerun"""
+    import app as app_module
+    import ingest
+
+    monkeypatch.setattr(app_module, 'analyze_document_content',
+                        lambda text: {'category': 'Data', 'subcategory': 'Tables', 'keywords': []})
+    monkeypatch.setenv('OPENAI_API_KEY', 'test-key')
+    source = tmp_path / 'archive'
+    (source / 'nested').mkdir(parents=True)
+    for i, folder in enumerate([source, source, source / 'nested']):
+        (folder / f'table{i}.csv').write_text(f'row,{i}\n')
+    (source / 'nested' / 'table0.csv').write_text('other,row\n')
+    (source / 'notes.txt').write_text('unsupported')
+    checkpoint = str(tmp_path / 'checkpoint.jsonl')
+    argv = [str(source), '--organized', 'test_organized', '--checkpoint', checkpoint, '--batch-size', '2']
+
+    assert ingest.main(argv) == 0
+    organized = os.path.join('test_organized', 'Documents', 'Data', 'Tables')
+    assert sorted(os.listdir(organized)) == ['table0.csv', 'table0_1.csv', 'table1.csv', 'table2.csv']
+    assert (source / 'table1.csv').exists()
+    with open(checkpoint) as f:
+        assert len(f.readlines()) == 4
+
+    (source / 'table9.csv').write_text('row,9\n')
+    args = ingest.parse_args(argv)
+    totals = ingest.run_ingest(args)
+    assert (totals['organized'], totals['skipped']) == (1, 4)